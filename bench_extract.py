@@ -0,0 +1,210 @@
+"""
+Бенчмарк разбора payload'ов YCLIENTS: старый разбор (цепочки `or` + перебор
+форматов даты через исключения) против планов по форме из booking_extract.
+
+    python bench_extract.py                  # встроенный корпус форм
+    python bench_extract.py --capture caps/  # + реальные payload'ы из журнала capture.py
+
+Сначала проверяет, что на каждом payload'е результаты совпадают, потом меряет.
+"""
+import sys
+import time
+import argparse
+from datetime import datetime
+
+import capture
+from booking_extract import (
+    safe_str,
+    normalize_phone,
+    extract_webhook,
+    extract_record,
+    plan_stats,
+)
+from config import YCLIENTS_COMPANY_ID
+
+
+# ------------------- СТАРЫЙ РАЗБОР (эталон, как было в main.py) -------------------
+def legacy_try_parse_dt(s: str):
+    if not s:
+        return None
+    s = str(s).strip()
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00")).replace(tzinfo=None)
+    except Exception:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"):
+        try:
+            return datetime.strptime(s, fmt)
+        except Exception:
+            continue
+    return None
+
+
+def legacy_webhook(payload: dict) -> dict:
+    d = payload.get("data") if isinstance(payload.get("data"), dict) else payload
+    status = safe_str(payload.get("status") or d.get("status") or "").lower().strip()
+    record_id = payload.get("resource_id") or d.get("id") or d.get("record_id") or d.get("appointment_id") or d.get("event_id")
+    record_id = safe_str(record_id)
+    company_id = payload.get("company_id") or d.get("company_id") or YCLIENTS_COMPANY_ID
+    try:
+        company_id = int(company_id)
+    except Exception:
+        company_id = int(YCLIENTS_COMPANY_ID)
+    phone_raw = None
+    if isinstance(d.get("client"), dict):
+        phone_raw = d["client"].get("phone") or d["client"].get("phone_number")
+    phone_raw = phone_raw or d.get("phone") or d.get("client_phone")
+    phone = normalize_phone(safe_str(phone_raw)) or safe_str(phone_raw)
+    start_str = d.get("start_at") or d.get("datetime") or d.get("date_time") or d.get("seance_date") or d.get("date")
+    start_dt = legacy_try_parse_dt(start_str) if start_str else None
+    return {"status": status, "record_id": record_id, "company_id": company_id, "phone": phone, "start_dt": start_dt}
+
+
+def legacy_record(rec: dict) -> dict:
+    phone_raw = None
+    if isinstance(rec.get("client"), dict):
+        phone_raw = rec["client"].get("phone") or rec["client"].get("phone_number")
+    phone_raw = phone_raw or rec.get("client_phone") or rec.get("phone")
+    phone = normalize_phone(safe_str(phone_raw)) or safe_str(phone_raw)
+    start_str = rec.get("datetime") or rec.get("date") or rec.get("start_at")
+    start_dt = legacy_try_parse_dt(start_str) if start_str else None
+    service = ""
+    price = ""
+    if isinstance(rec.get("services"), list) and rec["services"]:
+        s0 = rec["services"][0]
+        if isinstance(s0, dict):
+            service = s0.get("title") or s0.get("name") or ""
+            if s0.get("price") is not None:
+                price = safe_str(s0.get("price"))
+    if not service and isinstance(rec.get("service"), dict):
+        service = rec["service"].get("title") or rec["service"].get("name") or service
+        if not price and rec["service"].get("price") is not None:
+            price = safe_str(rec["service"].get("price"))
+    if not price:
+        price = safe_str(rec.get("price") or rec.get("cost") or rec.get("amount") or "")
+    master = ""
+    if isinstance(rec.get("staff"), dict):
+        master = rec["staff"].get("name") or master
+    if isinstance(rec.get("master"), dict):
+        master = rec["master"].get("name") or master
+    return {"phone": phone, "start_dt": start_dt, "service": safe_str(service), "master": safe_str(master), "price": safe_str(price)}
+
+
+# ------------------- КОРПУС -------------------
+def _record(i: int, date: str, **extra) -> dict:
+    rec = {
+        "id": 700000 + i,
+        "company_id": 530777,
+        "staff_id": 1200 + i % 5,
+        "services": [{"id": 9000 + i % 7, "title": "Маникюр с покрытием", "cost": 2200, "price": 2200, "amount": 1}],
+        "staff": {"id": 1200 + i % 5, "name": "Ольга", "specialization": "Мастер маникюра"},
+        "client": {"id": 55000 + i, "name": "Анна", "phone": f"+7917{1000000 + i}", "email": ""},
+        "date": date,
+        "datetime": date,
+        "create_date": "2026-01-20T10:11:12+0300",
+        "comment": "",
+        "online": True,
+        "attendance": 0,
+        "confirmed": 1,
+        "seance_length": 5400,
+        "length": 5400,
+        "deleted": False,
+    }
+    rec.update(extra)
+    return rec
+
+
+def builtin_corpus(n: int = 40) -> tuple[list[dict], list[dict]]:
+    """Формы, которые реально присылает YCLIENTS: с data и без, с телефоном и без, разные форматы даты."""
+    webhooks, records = [], []
+    for i in range(n):
+        iso = f"2026-02-{1 + i % 27:02d} {10 + i % 9:02d}:30:00"
+        ru = f"{1 + i % 27:02d}.02.2026 {10 + i % 9:02d}:30"
+        # 1) типовой webhook: данные в data, без телефона, дата в "date"
+        webhooks.append({"company_id": 530777, "resource": "record", "resource_id": 700000 + i, "status": "create",
+                         "data": {"id": 700000 + i, "date": iso, "staff_id": 1200, "services": [{"id": 9000}]}})
+        # 2) с клиентом и телефоном, дата в формате dd.mm.yyyy
+        webhooks.append({"company_id": 530777, "resource": "record", "resource_id": 700000 + i, "status": "create",
+                         "data": {"id": 700000 + i, "datetime": ru, "client": {"name": "Анна", "phone": f"8 917 {100 + i} 45 67"}}})
+        # 3) плоский webhook (без data), ISO с Z
+        webhooks.append({"record_id": 700000 + i, "status": "update", "client_phone": f"9171{100000 + i}",
+                         "start_at": f"2026-02-{1 + i % 27:02d}T07:30:00Z"})
+        # 4) полная запись из API
+        records.append(_record(i, iso))
+        # 5) запись с услугой в service и мастером в master, дата dd.mm.yyyy
+        records.append(_record(i, ru, services=[], service={"title": "Педикюр", "price": 2500},
+                               master={"name": "Ирина"}, datetime=None))
+    return webhooks, records
+
+
+def capture_corpus(path: str) -> tuple[list[dict], list[dict]]:
+    webhooks, records = [], []
+    for seg in capture.list_segments(path):
+        for e in capture.iter_segment(seg):
+            if e.get("t") == "in" and e.get("path", "").endswith("yclients-webhook") and isinstance(e.get("body"), dict):
+                webhooks.append(e["body"])
+            elif e.get("t") == "yc" and e.get("kind") == "record" and isinstance(e.get("result"), dict):
+                records.append(e["result"])
+    return webhooks, records
+
+
+# ------------------- ПРОГОН -------------------
+def _as_webhook_dict(b) -> dict:
+    return {"status": b.status, "record_id": b.record_id, "company_id": b.company_id, "phone": b.phone, "start_dt": b.start_dt}
+
+
+def _as_record_dict(b) -> dict:
+    return {"phone": b.phone, "start_dt": b.start_dt, "service": b.service, "master": b.master, "price": b.price}
+
+
+def check(webhooks: list[dict], records: list[dict]) -> int:
+    bad = 0
+    for p in webhooks:
+        if legacy_webhook(p) != _as_webhook_dict(extract_webhook(p)):
+            bad += 1
+            print(f"РАСХОЖДЕНИЕ webhook: {p}")
+    for r in records:
+        if legacy_record(r) != _as_record_dict(extract_record(r)):
+            bad += 1
+            print(f"РАСХОЖДЕНИЕ record: {r}")
+    return bad
+
+
+def _time(fn, items: list[dict], rounds: int) -> float:
+    best = float("inf")
+    for _ in range(5):
+        t = time.perf_counter()
+        for _ in range(rounds):
+            for it in items:
+                fn(it)
+        best = min(best, time.perf_counter() - t)
+    return best / (rounds * len(items)) if items else 0.0
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора payload'ов YCLIENTS")
+    parser.add_argument("--capture", help="папка журнала capture.py с реальными payload'ами")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    webhooks, records = builtin_corpus()
+    if args.capture:
+        w, r = capture_corpus(args.capture)
+        webhooks += w
+        records += r
+
+    bad = check(webhooks, records)
+    print(f"Корпус: {len(webhooks)} webhook, {len(records)} записей; расхождений: {bad}; {plan_stats()}")
+
+    for name, old, new, items in (
+        ("webhook", legacy_webhook, extract_webhook, webhooks),
+        ("record", legacy_record, extract_record, records),
+    ):
+        t_old = _time(old, items, args.rounds)
+        t_new = _time(new, items, args.rounds)
+        print(f"{name:8} старый {t_old * 1e6:7.2f} мкс  планы {t_new * 1e6:7.2f} мкс  ускорение x{t_old / t_new:.2f}")
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    cli()
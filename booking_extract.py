@@ -0,0 +1,293 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable
+
+from config import YCLIENTS_COMPANY_ID
+
+# ---------------------------------------------------------------------
+# Разбор payload'ов YCLIENTS (webhook и полная запись).
+# Одни и те же поля у YCLIENTS приходят под разными ключами, поэтому раньше
+# на каждом запросе перебирались цепочки `a or b or c`. Здесь для каждой
+# «формы» payload'а (набор ключей на нужных уровнях вложенности) один раз
+# строится план: какие из путей-кандидатов в этой форме вообще есть.
+# Дальше payload той же формы разбирается по готовому плану, а формат даты
+# для поля запоминается — без перебора форматов через исключения.
+# ---------------------------------------------------------------------
+MAX_PLANS = 512
+
+
+def safe_str(x) -> str:
+    return "" if x is None else str(x)
+
+
+def normalize_phone(text: str) -> str | None:
+    digits = re.sub(r"\D+", "", text or "")
+    if len(digits) < 10:
+        return None
+    # приводим к +7...
+    if digits.startswith("8") and len(digits) == 11:
+        digits = "7" + digits[1:]
+    if not digits.startswith("7") and len(digits) == 10:
+        digits = "7" + digits
+    if len(digits) != 11:
+        return None
+    return "+" + digits
+
+
+# ------------------- ДАТА/ВРЕМЯ -------------------
+def _parse_iso(s: str) -> datetime:
+    # ISO (иногда с Z)
+    return datetime.fromisoformat(s.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def _parse_ru(s: str) -> datetime:
+    # "27.01.2026 15:30" — самый частый не-ISO формат; если не ровно такой длины, отдаём strptime
+    if len(s) == 16 and s[2] == "." and s[5] == "." and s[10] == " " and s[13] == ":":
+        return datetime(int(s[6:10]), int(s[3:5]), int(s[0:2]), int(s[11:13]), int(s[14:16]))
+    return datetime.strptime(s, "%d.%m.%Y %H:%M")
+
+
+# порядок важен: тот же, что и в прежнем try_parse_dt (legacy_try_parse_dt в bench_extract.py)
+_DT_PARSERS: tuple[Callable[[str], datetime], ...] = (
+    _parse_iso,
+    lambda s: datetime.strptime(s, "%Y-%m-%d %H:%M:%S"),
+    lambda s: datetime.strptime(s, "%Y-%m-%d %H:%M"),
+    _parse_ru,
+)
+
+
+class DtParser:
+    """Запоминает, какой формат сработал в прошлый раз, и пробует его первым."""
+
+    __slots__ = ("learned",)
+
+    def __init__(self):
+        self.learned = -1
+
+    def parse(self, s) -> datetime | None:
+        if not s:
+            return None
+        s = str(s).strip()
+        if self.learned >= 0:
+            try:
+                return _DT_PARSERS[self.learned](s)
+            except ValueError:
+                pass
+        for i, parser in enumerate(_DT_PARSERS):
+            if i == self.learned:
+                continue
+            try:
+                dt = parser(s)
+            except ValueError:
+                continue
+            self.learned = i
+            return dt
+        return None
+
+
+# ------------------- ТИПИЗИРОВАННАЯ ЗАПИСЬ -------------------
+@dataclass(slots=True)
+class Booking:
+    status: str = ""
+    record_id: str = ""
+    company_id: int = 0
+    phone: str = ""
+    start_dt: datetime | None = None
+    service: str = ""
+    master: str = ""
+    price: str = ""
+
+    def merge(self, other: "Booking"):
+        """Непустые детали из other перекрывают наши (телефон, дата, услуга, мастер, цена)."""
+        for name in ("phone", "start_dt", "service", "master", "price"):
+            value = getattr(other, name)
+            if value:
+                setattr(self, name, value)
+
+
+# ------------------- ПЛАНЫ ПО ФОРМЕ PAYLOAD'А -------------------
+def _keys(x):
+    return tuple(x) if isinstance(x, dict) else None
+
+
+def _has_path(obj, path: tuple) -> bool:
+    for step in path:
+        if isinstance(step, int):
+            if not isinstance(obj, list) or len(obj) <= step:
+                return False
+        elif not isinstance(obj, dict) or step not in obj:
+            return False
+        obj = obj[step]
+    return True
+
+
+def _getter(path: tuple) -> Callable[[Any], Any]:
+    # форма гарантирует, что путь существует — берём по индексам напрямую
+    if len(path) == 1:
+        a, = path
+        return lambda o: o[a]
+    if len(path) == 2:
+        a, b = path
+        return lambda o: o[a][b]
+    a, b, c = path
+    return lambda o: o[a][b][c]
+
+
+_MISSING = object()
+
+
+def _chain(obj, candidates: tuple, mode: str = "or", default=_MISSING) -> Callable[[Any], Any]:
+    """
+    Компилирует цепочку кандидатов под конкретную форму.
+    mode="or":      первое истинное значение; иначе — как у `a or b or c`:
+                    последний операнд (default, если задан, иначе последний путь).
+    mode="notnone": первое значение, которое не None и не пустое после str().
+    """
+    present = tuple(_getter(p) for p in candidates if _has_path(obj, p))
+    if default is not _MISSING:
+        last = lambda o: default
+    elif candidates and _has_path(obj, candidates[-1]):
+        last = _getter(candidates[-1])
+    else:
+        last = lambda o: None
+
+    if not present:
+        return last
+    if mode == "notnone":
+        def run(o):
+            for g in present:
+                v = g(o)
+                if v is not None and safe_str(v):
+                    return v
+            return last(o)
+    elif len(present) == 1:
+        g0 = present[0]
+        def run(o):
+            return g0(o) or last(o)
+    else:
+        def run(o):
+            for g in present:
+                v = g(o)
+                if v:
+                    return v
+            return last(o)
+    return run
+
+
+class _Plan:
+    __slots__ = ("fields", "dt")
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+        self.dt = DtParser()
+
+
+def _webhook_shape(p: dict):
+    d = p.get("data")
+    if isinstance(d, dict):
+        return (tuple(p), tuple(d), _keys(d.get("client")))
+    return (tuple(p), None, _keys(p.get("client")))
+
+
+def _compile_webhook(p: dict) -> _Plan:
+    D = ("data",) if isinstance(p.get("data"), dict) else ()
+    return _Plan({
+        "status": _chain(p, (("status",), D + ("status",)), default=""),
+        "record_id": _chain(p, (("resource_id",), D + ("id",), D + ("record_id",), D + ("appointment_id",), D + ("event_id",))),
+        "company_id": _chain(p, (("company_id",), D + ("company_id",)), default=YCLIENTS_COMPANY_ID),
+        "phone": _chain(p, (D + ("client", "phone"), D + ("client", "phone_number"), D + ("phone",), D + ("client_phone",))),
+        "start": _chain(p, (D + ("start_at",), D + ("datetime",), D + ("date_time",), D + ("seance_date",), D + ("date",))),
+    })
+
+
+def _record_shape(r: dict):
+    services = r.get("services")
+    s0 = _keys(services[0]) if isinstance(services, list) and services else None
+    return (tuple(r), _keys(r.get("client")), s0, _keys(r.get("service")), _keys(r.get("staff")), _keys(r.get("master")))
+
+
+def _compile_record(r: dict) -> _Plan:
+    S0 = ("services", 0)
+    return _Plan({
+        "phone": _chain(r, (("client", "phone"), ("client", "phone_number"), ("client_phone",), ("phone",))),
+        "start": _chain(r, (("datetime",), ("date",), ("start_at",))),
+        "s0_title": _chain(r, (S0 + ("title",), S0 + ("name",)), default=""),
+        "s0_price": _chain(r, (S0 + ("price",),), mode="notnone", default=None),
+        "svc_title": _chain(r, (("service", "title"), ("service", "name")), default=""),
+        "svc_price": _chain(r, (("service", "price"),), mode="notnone", default=None),
+        "rec_price": _chain(r, (("price",), ("cost",), ("amount",)), default=""),
+        "master": _chain(r, (("master", "name"), ("staff", "name")), default=""),
+    })
+
+
+_webhook_plans: dict = {}
+_record_plans: dict = {}
+
+
+def _plan(cache: dict, shape, compile_fn, obj) -> _Plan:
+    plan = cache.get(shape)
+    if plan is None:
+        if len(cache) >= MAX_PLANS:
+            cache.clear()
+        plan = cache[shape] = compile_fn(obj)
+    return plan
+
+
+def plan_stats() -> dict:
+    return {"webhook_shapes": len(_webhook_plans), "record_shapes": len(_record_plans)}
+
+
+# ------------------- ИЗВЛЕЧЕНИЕ -------------------
+def extract_webhook(payload: dict) -> Booking:
+    """
+    YCLIENTS присылает часто такую форму:
+    {"company_id":..., "resource":"record", "resource_id":..., "status":"create|update|delete", "data":{...}}
+    Телефона внутри data обычно нет — тогда детали добираются через extract_record.
+    """
+    plan = _plan(_webhook_plans, _webhook_shape(payload), _compile_webhook, payload)
+    f = plan.fields
+
+    company_id = f["company_id"](payload)
+    try:
+        company_id = int(company_id)
+    except Exception:
+        company_id = int(YCLIENTS_COMPANY_ID)
+
+    phone_raw = safe_str(f["phone"](payload))
+    start_str = f["start"](payload)
+
+    return Booking(
+        status=safe_str(f["status"](payload)).lower().strip(),
+        record_id=safe_str(f["record_id"](payload)),
+        company_id=company_id,
+        phone=normalize_phone(phone_raw) or phone_raw,
+        start_dt=plan.dt.parse(start_str) if start_str else None,
+    )
+
+
+def extract_record(rec: dict) -> Booking:
+    """Полная запись YCLIENTS: телефон/дата/услуга/мастер/стоимость."""
+    plan = _plan(_record_plans, _record_shape(rec), _compile_record, rec)
+    f = plan.fields
+
+    phone_raw = safe_str(f["phone"](rec))
+    start_str = f["start"](rec)
+
+    service = f["s0_title"](rec)
+    price = safe_str(f["s0_price"](rec))
+    # услуга из service — только если в services её не нашли (как и раньше)
+    if not service:
+        service = f["svc_title"](rec)
+        if not price:
+            price = safe_str(f["svc_price"](rec))
+    if not price:
+        price = safe_str(f["rec_price"](rec))
+
+    return Booking(
+        phone=normalize_phone(phone_raw) or phone_raw,
+        start_dt=plan.dt.parse(start_str) if start_str else None,
+        service=safe_str(service),
+        master=safe_str(f["master"](rec)),
+        price=price,
+    )
@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import itertools
+import contextvars
+from typing import Any, Iterator
+
+logger = logging.getLogger("capture")
+
+# ---------------------------------------------------------------------
+# Запись входящих webhook (и того, что бот на них ответил) в журнал,
+# чтобы потом прогнать реальный трафик офлайн через replay.py.
+# Включается переменной WEBHOOK_CAPTURE_DIR. Журнал — append-only,
+# по одному JSON на строку, сегменты режутся по размеру.
+# ---------------------------------------------------------------------
+CAPTURE_DIR = os.getenv("WEBHOOK_CAPTURE_DIR", "")
+CAPTURE_SEGMENT_BYTES = int(os.getenv("WEBHOOK_CAPTURE_SEGMENT_MB", "16")) * 1024 * 1024
+CAPTURE_REDACT_PII = os.getenv("WEBHOOK_CAPTURE_REDACT_PII", "true").lower() == "true"
+
+SEGMENT_PREFIX = "capture-"
+SEGMENT_SUFFIX = ".jsonl"
+
+_REDACT_HEADERS = {"authorization", "cookie", "x-webhook-secret", "x-telegram-bot-api-secret-token", "x-partner-token"}
+_REDACT_QUERY = {"secret", "token"}
+_PHONE_KEYS = {"phone", "phone_number", "client_phone"}
+_NAME_KEYS = {"first_name", "last_name", "username"}
+# "name" есть и у мастера/услуги — прячем его только внутри карточки клиента
+_CLIENT_NAME_KEYS = {"name", "fullname", "surname", "patronymic", "display_name"}
+# российский номер в свободной записи: +7 (9xx) xxx-xx-xx, 89xxxxxxxxx, 9xxxxxxxxx
+_PHONE_RE = re.compile(r"(?<![\d:])(?:\+?7|8)?[\s\-(]*[3-9]\d{2}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}(?![\d:])")
+
+# код, под которым выдаём фейковые номера (сервисные 80x, личных номеров там нет)
+_PSEUDO_DEF = "80"
+
+# id входящего запроса, к которому привязываем исходящие сообщения
+current_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("capture_request_id", default="")
+
+_seq = itertools.count(1)
+_segment_no = 0
+_segment_file = None
+_segment_size = 0
+
+
+def enabled() -> bool:
+    return bool(CAPTURE_DIR)
+
+
+# ------------------- РЕДАКЦИЯ -------------------
+def pseudo_phone(value: str) -> str:
+    """
+    Детерминированная подмена номера: один и тот же номер (в любом формате) всегда
+    превращается в один и тот же фейковый +7..., так что привязки при replay сохраняются.
+    Фейковые номера — из сервисного диапазона +7 80x (не личные), и подмена идемпотентна:
+    повторный redact() их не меняет. На этом держится сравнение в replay — свежие
+    исходящие прогоняются через redact() и совпадают с уже отредактированным журналом.
+    """
+    digits = re.sub(r"\D+", "", value or "")
+    if len(digits) < 10:
+        return value
+    if digits[-10:].startswith(_PSEUDO_DEF):
+        return "+7" + digits[-10:]
+    h = hashlib.sha1(digits[-10:].encode()).hexdigest()
+    return "+7" + _PSEUDO_DEF + str(int(h, 16))[:8]
+
+
+def _redact_text(s: str) -> str:
+    return _PHONE_RE.sub(lambda m: pseudo_phone(m.group(0)), s)
+
+
+def redact(obj: Any, key: str = "", parent: str = "") -> Any:
+    if not CAPTURE_REDACT_PII:
+        return obj
+    if isinstance(obj, dict):
+        return {k: redact(v, k, key) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [redact(v, key, parent) for v in obj]
+    if isinstance(obj, str):
+        if key in _PHONE_KEYS:
+            return pseudo_phone(obj)
+        if key in _NAME_KEYS or (parent == "client" and key in _CLIENT_NAME_KEYS):
+            return "REDACTED"
+        return _redact_text(obj)
+    return obj
+
+
+def _redact_headers(headers: dict) -> dict:
+    return {k: ("***" if k.lower() in _REDACT_HEADERS else v) for k, v in headers.items()}
+
+
+def _redact_query(query: dict) -> dict:
+    return {k: ("***" if k.lower() in _REDACT_QUERY else v) for k, v in query.items()}
+
+
+# ------------------- ЗАПИСЬ -------------------
+def _open_segment():
+    global _segment_no, _segment_file, _segment_size
+    if _segment_file:
+        _segment_file.close()
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    _segment_no += 1
+    name = f"{SEGMENT_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{_segment_no:04d}{SEGMENT_SUFFIX}"
+    _segment_file = open(os.path.join(CAPTURE_DIR, name), "a", encoding="utf-8")
+    _segment_size = 0
+
+
+def _append(entry: dict):
+    global _segment_size
+    try:
+        if _segment_file is None or _segment_size >= CAPTURE_SEGMENT_BYTES:
+            _open_segment()
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+        _segment_file.write(line)
+        _segment_file.flush()
+        _segment_size += len(line.encode("utf-8"))
+    except Exception as e:
+        logger.error(f"capture write error: {e}")
+
+
+def capture_inbound(path: str, query: dict, headers: dict, body: Any) -> str:
+    """Записать входящий запрос. Возвращает id, к которому привяжутся исходящие."""
+    if not enabled():
+        return ""
+    rid = f"{os.getpid()}-{next(_seq)}"
+    current_request_id.set(rid)
+    _append({
+        "t": "in",
+        "id": rid,
+        "ts": time.time(),
+        "path": path,
+        "query": _redact_query(query),
+        "headers": _redact_headers(headers),
+        "body": redact(body),
+    })
+    return rid
+
+
+def capture_outbound(method: str, payload: dict):
+    """Исходящий вызов Telegram API в рамках текущего входящего запроса."""
+    if not enabled():
+        return
+    _append({"t": "out", "id": current_request_id.get(), "ts": time.time(), "method": method, "payload": redact(payload)})
+
+
+def capture_upstream(kind: str, key: str, result: Any):
+    """Ответ YCLIENTS (например, get_record_by_id) — чтобы replay мог отдать его из заглушки."""
+    if not enabled():
+        return
+    _append({"t": "yc", "id": current_request_id.get(), "ts": time.time(), "kind": kind, "key": str(key), "result": redact(result)})
+
+
+def close():
+    global _segment_file
+    if _segment_file:
+        _segment_file.close()
+        _segment_file = None
+
+
+# ------------------- ЧТЕНИЕ -------------------
+def list_segments(path: str) -> list[str]:
+    if os.path.isfile(path):
+        return [path]
+    names = sorted(n for n in os.listdir(path) if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(path, n) for n in names]
+
+
+def iter_segment(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except Exception:
+                # последняя строка могла быть недописана при убийстве воркера
+                logger.warning(f"capture: битая строка в {path}")
@@ -1,7 +1,7 @@
 import os
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import String, Integer, BigInteger, DateTime, Text, func
+from sqlalchemy import String, Integer, BigInteger, DateTime, Text, UniqueConstraint, func
 from sqlalchemy.orm import Mapped, mapped_column
 
 DATABASE_URL = os.getenv("DATABASE_URL", "")
@@ -32,6 +32,15 @@ class DialogState(Base):
     payload: Mapped[str] = mapped_column(Text, default="{}")  # JSON строкой
     updated_at: Mapped[DateTime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
 
+class SentEvent(Base):
+    __tablename__ = "sent_events"
+    __table_args__ = (UniqueConstraint("record_id", "kind"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    record_id: Mapped[str] = mapped_column(String(64), index=True)
+    kind: Mapped[str] = mapped_column(String(32))
+    payload: Mapped[str] = mapped_column(Text, default="true")  # JSON строкой (extra из mark_sent)
+    created_at: Mapped[DateTime] = mapped_column(DateTime, server_default=func.now())
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import bisect
+import logging
+
+from booking_extract import safe_str
+
+logger = logging.getLogger("lookup")
+
+# ---------------------------------------------------------------------
+# Индексы для админских команд /find, /record, /chat.
+# Держим в памяти представления над MEMORY_FILE и SENT_FILE:
+#   - отсортированный список цифр телефонов (поиск по префиксу — bisect);
+#   - телефон -> чаты, чат -> телефон/шаг;
+#   - запись -> отметки об отправке, телефон/чат -> записи.
+# Индекс перестраивается только когда файл изменился (mtime/размер) —
+# например, его записал другой воркер. Свои изменения воркер вносит в индекс
+# точечно (note_state/note_sent), так что ответ на команду не зависит от
+# числа клиентов.
+# ---------------------------------------------------------------------
+
+
+def phone_digits(phone: str) -> str:
+    return re.sub(r"\D+", "", phone or "")
+
+
+def phone_prefix(query: str) -> str:
+    """Префикс для поиска: в индексе номера вида 7XXXXXXXXXX, поэтому 8... и 9... приводим к 7..."""
+    digits = phone_digits(query)
+    if digits.startswith("8"):
+        return "7" + digits[1:]
+    if digits.startswith("9"):
+        return "7" + digits
+    return digits
+
+
+def _stat(path: str):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def _load(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        return d if isinstance(d, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Не смог прочитать {path}: {e}")
+        return {}
+
+
+def _put_chat(chats: dict, phone_chats: dict, chat_id: int, st: dict):
+    phone = safe_str((st.get("data") or {}).get("phone"))
+    chats[chat_id] = {"step": st.get("step", "idle"), "phone": phone}
+    if phone:
+        phone_chats.setdefault(phone_digits(phone), set()).add(chat_id)
+
+
+def _put_sent(records: dict, phone_records: dict, chat_records: dict, record_id: str, kind: str, extra):
+    records.setdefault(record_id, {})[kind] = extra
+    if isinstance(extra, dict):
+        if extra.get("phone"):
+            phone_records.setdefault(phone_digits(str(extra["phone"])), set()).add(record_id)
+        try:
+            chat_records.setdefault(int(extra.get("chat_id")), set()).add(record_id)
+        except Exception:
+            pass
+
+
+class LookupIndex:
+    def __init__(self, memory_path: str, sent_path: str):
+        self.memory_path = memory_path
+        self.sent_path = sent_path
+        self._sig: dict[str, tuple | None] = {}
+        # состояние чатов
+        self.chats: dict[int, dict] = {}
+        self.phone_chats: dict[str, set[int]] = {}
+        self.phone_keys: list[str] = []
+        # отметки об отправке
+        self.records: dict[str, dict] = {}
+        self.phone_records: dict[str, set[str]] = {}
+        self.chat_records: dict[int, set[str]] = {}
+
+    # ---------- актуальность ----------
+    def is_fresh(self, path: str) -> bool:
+        """Индекс по path построен и файл с тех пор никто не менял."""
+        return path in self._sig and self._sig[path] == _stat(path)
+
+    def refresh(self):
+        """Перестроить то, что устарело. Можно звать из потока (прогрев на старте)."""
+        # подпись берём до чтения и ставим после сборки: пока индекс строится,
+        # is_fresh() ложно, и запись в файл не пытается править его точечно
+        for path, build in ((self.memory_path, self._build_memory), (self.sent_path, self._build_sent)):
+            if not self.is_fresh(path):
+                sig = _stat(path)
+                build(_load(path))
+                self._sig[path] = sig
+
+    def _build_memory(self, mem: dict):
+        chats: dict[int, dict] = {}
+        phone_chats: dict[str, set[int]] = {}
+        for chat_id_str, st in mem.items():
+            try:
+                chat_id = int(chat_id_str)
+            except Exception:
+                continue
+            _put_chat(chats, phone_chats, chat_id, st or {})
+        self.chats, self.phone_chats, self.phone_keys = chats, phone_chats, sorted(phone_chats)
+
+    def _build_sent(self, sent: dict):
+        records: dict[str, dict] = {}
+        phone_records: dict[str, set[str]] = {}
+        chat_records: dict[int, set[str]] = {}
+        for record_id, kinds in sent.items():
+            if isinstance(kinds, dict):
+                for kind, extra in kinds.items():
+                    _put_sent(records, phone_records, chat_records, str(record_id), kind, extra)
+        self.records, self.phone_records, self.chat_records = records, phone_records, chat_records
+
+    # ---------- точечные изменения ----------
+    def note_state(self, chat_id: int, step: str, data: dict):
+        """Воркер сам записал состояние чата (вызывать, только если is_fresh был True до записи)."""
+        old = self.chats.get(chat_id)
+        if old and old["phone"]:
+            key = phone_digits(old["phone"])
+            chats = self.phone_chats.get(key)
+            if chats:
+                chats.discard(chat_id)
+                if not chats:
+                    del self.phone_chats[key]
+                    i = bisect.bisect_left(self.phone_keys, key)
+                    if i < len(self.phone_keys) and self.phone_keys[i] == key:
+                        del self.phone_keys[i]
+        _put_chat(self.chats, self.phone_chats, chat_id, {"step": step, "data": data})
+        phone = self.chats[chat_id]["phone"]
+        if phone:
+            key = phone_digits(phone)
+            i = bisect.bisect_left(self.phone_keys, key)
+            if i >= len(self.phone_keys) or self.phone_keys[i] != key:
+                self.phone_keys.insert(i, key)
+        self._sig[self.memory_path] = _stat(self.memory_path)
+
+    def note_sent(self, record_id: str, kind: str, extra):
+        """Воркер сам отметил отправку (вызывать, только если is_fresh был True до записи)."""
+        _put_sent(self.records, self.phone_records, self.chat_records, str(record_id), kind, extra)
+        self._sig[self.sent_path] = _stat(self.sent_path)
+
+    # ---------- запросы ----------
+    def find(self, prefix: str, offset: int, limit: int) -> tuple[list[tuple[str, list[int]]], int]:
+        """Телефоны с цифрами на prefix: (страница [(цифры, [chat_id...])], всего совпадений)."""
+        self.refresh()
+        lo = bisect.bisect_left(self.phone_keys, prefix)
+        # ":" идёт сразу за "9" — верхняя граница всех строк цифр с этим префиксом
+        hi = bisect.bisect_left(self.phone_keys, prefix + ":", lo)
+        page = self.phone_keys[lo + offset: min(hi, lo + offset + limit)]
+        return [(key, sorted(self.phone_chats[key])) for key in page], hi - lo
+
+    def chat(self, chat_id: int) -> dict | None:
+        self.refresh()
+        return self.chats.get(chat_id)
+
+    def chat_record_ids(self, chat_id: int) -> list[str]:
+        """Записи чата: отмеченные с его chat_id или с его телефоном. Новые (по ts) — первыми."""
+        self.refresh()
+        ids = set(self.chat_records.get(chat_id, ()))
+        st = self.chats.get(chat_id)
+        if st and st["phone"]:
+            ids |= self.phone_records.get(phone_digits(st["phone"]), set())
+        return sorted(ids, key=lambda rid: (self._record_ts(rid), rid), reverse=True)
+
+    def record(self, record_id: str) -> dict | None:
+        self.refresh()
+        return self.records.get(str(record_id))
+
+    def chats_for_phone(self, phone: str) -> list[int]:
+        self.refresh()
+        return sorted(self.phone_chats.get(phone_digits(phone), ()))
+
+    def _record_ts(self, record_id: str) -> str:
+        ts = ""
+        for extra in self.records.get(record_id, {}).values():
+            if isinstance(extra, dict) and str(extra.get("ts") or "") > ts:
+                ts = str(extra["ts"])
+        return ts
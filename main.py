@@ -1,6 +1,8 @@
 import os
 import json
-import re
+import time
+import signal
+import asyncio
 import logging
 import aiohttp
 import html
@@ -9,6 +11,16 @@ from datetime import datetime
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
+import capture
+import stats
+from lookup import LookupIndex, phone_prefix
+from booking_extract import (
+    safe_str,
+    normalize_phone,
+    Booking,
+    extract_webhook,
+    extract_record,
+)
 from config import TELEGRAM_TOKEN, YCLIENTS_COMPANY_ID
 from yclients_api import (
     # оставлено для совместимости (старый сценарий записи)
@@ -20,46 +32,24 @@ from yclients_api import (
     get_headers,
     BASE_URL,
     get_record_by_id,
+    # справочники мастеров/услуг (кэш)
+    ensure_reference_data,
+    reference_refresh_loop,
+    resolve_record_refs,
+    # состояние circuit breaker'ов YCLIENTS
+    breaker_states,
+    is_degraded,
+    close_session as close_yclients_session,
+    # будущие записи клиента (после привязки номера)
+    find_client_ids_by_phone,
+    get_upcoming_records,
+    YClientsUnavailable,
 )
 
 # ------------------- УТИЛИТЫ -------------------
-def safe_str(x) -> str:
-    return "" if x is None else str(x)
-
 def escape_html(s: str) -> str:
     return html.escape(s or "")
 
-def try_parse_dt(s: str):
-    """Пытаемся распарсить дату/время из разных форматов (в т.ч. '2026-01-27 15:30:00')."""
-    if not s:
-        return None
-    s = str(s).strip()
-    # ISO (иногда с Z)
-    try:
-        return datetime.fromisoformat(s.replace("Z", "+00:00")).replace(tzinfo=None)
-    except Exception:
-        pass
-    # Частые форматы
-    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"):
-        try:
-            return datetime.strptime(s, fmt)
-        except Exception:
-            continue
-    return None
-
-def normalize_phone(text: str) -> str | None:
-    digits = re.sub(r"\D+", "", text or "")
-    if len(digits) < 10:
-        return None
-    # приводим к +7...
-    if digits.startswith("8") and len(digits) == 11:
-        digits = "7" + digits[1:]
-    if not digits.startswith("7") and len(digits) == 10:
-        digits = "7" + digits
-    if len(digits) != 11:
-        return None
-    return "+" + digits
-
 def md_sanitize(s: str) -> str:
     """Мини-санитайзер под Telegram Markdown (legacy), чтобы динамические поля не ломали разметку."""
     if not s:
@@ -89,6 +79,8 @@ YCLIENTS_WEBHOOK_SECRET = os.getenv("YCLIENTS_WEBHOOK_SECRET", "")
 MEMORY_FILE = "dialog_memory.json"
 # чтобы не дублить отбивки
 SENT_FILE = "sent_events.json"
+# индексы для /find, /record, /chat
+lookup_index = LookupIndex(MEMORY_FILE, SENT_FILE)
 
 # ------------------- ХРАНИЛКИ -------------------
 def _load_json(path: str) -> dict:
@@ -102,20 +94,43 @@ def _load_json(path: str) -> dict:
         return {}
 
 def _save_json(path: str, data: dict):
+    # пишем во временный файл и атомарно подменяем — убитый посреди записи воркер
+    # не оставит полуобрезанный JSON
+    tmp = f"{path}.{os.getpid()}.tmp"
     try:
-        with open(path, "w", encoding="utf-8") as f:
+        with open(tmp, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
     except Exception as e:
         logger.error(f"Не смог сохранить {path}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
 
 def get_state(chat_id: int) -> dict:
     mem = _load_json(MEMORY_FILE)
     return mem.get(str(chat_id), {"step": "idle", "data": {}})
 
 def set_state(chat_id: int, step: str, data: dict):
+    indexed = lookup_index.is_fresh(MEMORY_FILE)
     mem = _load_json(MEMORY_FILE)
-    mem[str(chat_id)] = {"step": step, "data": data}
+    prev = mem.get(str(chat_id)) or {}
+    old_phone = (prev.get("data") or {}).get("phone")
+    new_phone = (data or {}).get("phone")
+    # "linked" — последний номер, который чат привязывал; переживает reset_state,
+    # чтобы повторная привязка после /start не считалась новым клиентом
+    last_linked = prev.get("linked") or old_phone
+    entry = {"step": step, "data": data}
+    if new_phone or last_linked:
+        entry["linked"] = new_phone or last_linked
+    mem[str(chat_id)] = entry
     _save_json(MEMORY_FILE, mem)
+    if indexed:
+        lookup_index.note_state(chat_id, step, data)
+    count_phone_change(old_phone, new_phone, last_linked)
 
 def reset_state(chat_id: int):
     set_state(chat_id, "idle", {})
@@ -136,20 +151,223 @@ def was_sent(record_id: str, kind: str) -> bool:
     return bool(sent.get(record_id, {}).get(kind))
 
 def mark_sent(record_id: str, kind: str, extra: dict | None = None):
+    indexed = lookup_index.is_fresh(SENT_FILE)
     sent = _load_json(SENT_FILE)
     sent.setdefault(record_id, {})
     sent[record_id][kind] = extra or True
     _save_json(SENT_FILE, sent)
+    if indexed:
+        lookup_index.note_sent(record_id, kind, extra or True)
+
+# ------------------- СТАТИСТИКА -------------------
+def _count_linked_chats() -> int:
+    """Один раз — чтобы стартовать счётчик привязанных клиентов с реального значения."""
+    mem = _load_json(MEMORY_FILE)
+    return sum(1 for st in mem.values() if ((st or {}).get("data") or {}).get("phone"))
+
+def count_phone_change(old_phone, new_phone, last_linked):
+    """Номер у чата появился/пропал — двигаем счётчик привязанных; новый номер — событие."""
+    if bool(old_phone) != bool(new_phone):
+        delta = 1 if new_phone else -1
+        # изменение уже сохранено в MEMORY_FILE, поэтому стартовое значение без него
+        stats.adjust_gauge("linked_clients", delta, initial=lambda: _count_linked_chats() - delta)
+    if new_phone and new_phone != last_linked:
+        stats.incr("phone_linked")
+
+# ------------------- ЖИЗНЕННЫЙ ЦИКЛ -------------------
+# Воркер gunicorn перезапускают при деплое: по SIGTERM перестаём брать новые
+# запросы (503 — Telegram/YCLIENTS повторят доставку в другой воркер), ждём
+# текущие обработчики и фоновые задачи, а всё, что не успело, сохраняем в
+# отдельный pending_work-*.json. Забирают его живые воркеры — на старте и
+# периодически: при graceful reload (HUP) новые воркеры стартуют раньше, чем
+# старые получают SIGTERM, так что одного захвата на старте мало.
+PENDING_FILE = "pending_work.json"  # общий файл от старых версий — тоже забираем
+PENDING_PREFIX = "pending_work-"
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+PENDING_POLL_SECONDS = float(os.getenv("PENDING_POLL_SECONDS", "5"))
+
+# kind -> async fn(**params): фоновые задачи, которые можно перезапустить в другом воркере
+JOB_HANDLERS: dict = {}
+
+class Lifecycle:
+    def __init__(self):
+        self.accepting = True
+        self.inflight = 0
+        self.tasks: dict[asyncio.Task, dict | None] = {}
+        self.outbox: dict[int, dict] = {}
+        self._ticket = 0
+
+    # --- фоновые задачи ---
+    def spawn(self, coro, job: dict | None = None) -> asyncio.Task:
+        """
+        Запустить задачу в фоне под присмотром. job = {"kind": ..., "params": {...}} —
+        описание, по которому задачу можно перезапустить, если воркер погасят раньше.
+        """
+        task = asyncio.create_task(coro)
+        self.tasks[task] = job
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self.tasks.pop(task, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Фоновая задача упала: {task.exception()!r}")
+
+    # --- исходящие сообщения ---
+    def outbox_add(self, method: str, payload: dict) -> int:
+        self._ticket += 1
+        self.outbox[self._ticket] = {"method": method, "payload": payload}
+        return self._ticket
+
+    def outbox_done(self, ticket: int):
+        self.outbox.pop(ticket, None)
+
+    # --- остановка ---
+    async def shutdown(self, deadline: float = SHUTDOWN_DRAIN_SECONDS):
+        self.accepting = False
+        until = time.monotonic() + deadline
+        logger.info(f"Остановка: в работе {self.inflight} запросов, {len(self.tasks)} задач, {len(self.outbox)} отправок")
+
+        while (self.inflight or self.tasks) and time.monotonic() < until:
+            if self.tasks:
+                await asyncio.wait(list(self.tasks), timeout=max(0.0, until - time.monotonic()))
+            else:
+                await asyncio.sleep(0.05)
+
+        leftover_jobs = [job for task, job in self.tasks.items() if job]
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=1)
+
+        if leftover_jobs or self.outbox:
+            # свой файл на каждый воркер: не дописываем в общий, который в этот момент
+            # может забирать другой воркер
+            path = f"{PENDING_PREFIX}{os.getpid()}-{time.time_ns()}.json"
+            _save_json(path, {"jobs": leftover_jobs, "outbox": list(self.outbox.values())})
+            logger.warning(f"Не успели: {len(leftover_jobs)} задач, {len(self.outbox)} отправок — сохранено в {path}")
+
+    def resume_pending(self):
+        """Забрать недоделанное остановленными воркерами (rename атомарен — файл заберёт ровно один воркер)."""
+        if not self.accepting:
+            return
+        try:
+            names = [n for n in os.listdir(".") if n == PENDING_FILE or (n.startswith(PENDING_PREFIX) and n.endswith(".json"))]
+        except OSError:
+            return
+        for name in names:
+            claimed = f"{name}.claimed.{os.getpid()}"
+            try:
+                os.replace(name, claimed)
+            except FileNotFoundError:
+                continue
+            pending = _load_json(claimed)
+            os.remove(claimed)
+            for item in pending.get("outbox", []):
+                self.spawn(tg_post(item["method"], item["payload"]))
+            for job in pending.get("jobs", []):
+                handler = JOB_HANDLERS.get(job.get("kind"))
+                if handler:
+                    self.spawn(handler(**job.get("params", {})), job=job)
+            logger.info(f"Подхватили из {name}: {len(pending.get('outbox', []))} отправок, {len(pending.get('jobs', []))} задач")
+
+lifecycle = Lifecycle()
+
+async def pending_claim_loop():
+    """Фоновая задача: забирать недоделанное воркерами, которых погасили уже после нашего старта."""
+    while True:
+        await asyncio.sleep(PENDING_POLL_SECONDS)
+        try:
+            lifecycle.resume_pending()
+        except Exception as e:
+            logger.error(f"pending claim loop error: {e}")
+
+@app.middleware("http")
+async def _track_inflight(request: Request, call_next):
+    if request.method != "POST":
+        return await call_next(request)
+    if not lifecycle.accepting:
+        return JSONResponse(status_code=503, content={"ok": False, "error": "shutting down"})
+    lifecycle.inflight += 1
+    try:
+        return await call_next(request)
+    finally:
+        lifecycle.inflight -= 1
+
+def _install_sigterm_hook():
+    # не заменяем обработчик сервера, а встаём перед ним: сначала закрываем приём, потом штатная остановка
+    prev = signal.getsignal(signal.SIGTERM)
+
+    def _on_sigterm(signum, frame):
+        lifecycle.accepting = False
+        if callable(prev):
+            prev(signum, frame)
+        elif prev == signal.SIG_IGN:
+            logger.info("SIGTERM: приём закрыт, сигнал игнорируется (так было до хука)")
+        else:
+            # до нас стоял SIG_DFL (или не-Python обработчик) — возвращаем его и шлём сигнал заново,
+            # иначе процесс так и не завершится
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    try:
+        signal.signal(signal.SIGTERM, _on_sigterm)
+    except ValueError:
+        # приложение крутится не в главном потоке (тесты/встраивание) — сигналы не наши
+        logger.info("SIGTERM-хук не установлен: не главный поток")
+
+@app.on_event("startup")
+async def _on_startup():
+    _install_sigterm_hook()
+    # справочники мастеров/услуг обновляем в фоне, чтобы webhook не ходил за ними в API
+    app.state.refdata_task = asyncio.create_task(reference_refresh_loop(YCLIENTS_COMPANY_ID))
+    lifecycle.resume_pending()
+    app.state.pending_task = asyncio.create_task(pending_claim_loop())
+    # индексы для /find /chat /record строим заранее, а не на первой команде админа
+    app.state.lookup_task = asyncio.create_task(asyncio.to_thread(lookup_index.refresh))
+
+@app.on_event("shutdown")
+async def _on_shutdown():
+    app.state.refdata_task.cancel()
+    app.state.pending_task.cancel()
+    await lifecycle.shutdown()
+    capture.close()
+    await close_yclients_session()
+    await close_tg_session()
 
 # ------------------- TELEGRAM HELPERS -------------------
+_tg_session: aiohttp.ClientSession | None = None
+
+def _get_tg_session() -> aiohttp.ClientSession:
+    global _tg_session
+    if _tg_session is None or _tg_session.closed:
+        _tg_session = aiohttp.ClientSession()
+    return _tg_session
+
+async def close_tg_session():
+    global _tg_session
+    if _tg_session is not None and not _tg_session.closed:
+        await _tg_session.close()
+    _tg_session = None
+
 async def tg_post(method: str, payload: dict):
     url = f"{TELEGRAM_API}/{method}"
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as resp:
+    capture.capture_outbound(method, payload)
+    ticket = lifecycle.outbox_add(method, payload)
+    cancelled = False
+    try:
+        async with _get_tg_session().post(url, json=payload) as resp:
             try:
                 return await resp.json()
             except Exception:
                 return {"ok": False, "raw": await resp.text()}
+    except asyncio.CancelledError:
+        # воркер гасят посреди отправки — сообщение останется в outbox и уйдёт из следующего воркера
+        cancelled = True
+        raise
+    finally:
+        if not cancelled:
+            lifecycle.outbox_done(ticket)
 
 async def send_message(chat_id: int, text: str, reply_markup: dict | None = None, parse_mode: str = "Markdown"):
     payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "disable_web_page_preview": True}
@@ -244,95 +462,160 @@ def tpl_booking_created(service: str, master: str, price: str, dt_str: str) -> s
 async def send_chatid(chat_id: int):
     await send_message(chat_id, f"chat_id = {chat_id}", parse_mode="Markdown")
 
-# ------------------- YCLIENTS WEBHOOK -------------------
-def extract_from_yclients_webhook(payload: dict) -> dict:
-    """
-    YCLIENTS присылает часто такую форму:
-    {"company_id":..., "resource":"record", "resource_id":..., "status":"create|update|delete", "data":{...}}
-    Внутри payload["data"] обычно НЕТ телефона клиента, поэтому при отсутствии телефона мы будем
-    дополнительно запрашивать запись по record_id через API.
-    """
-    d = payload.get("data") if isinstance(payload.get("data"), dict) else payload
-
-    # статус
-    status = safe_str(payload.get("status") or d.get("status") or "").lower().strip()
+# ------------------- /stats (только админ) -------------------
+async def send_stats(chat_id: int):
+    windows = stats.summary()
+    linked = stats.get_gauge("linked_clients", initial=_count_linked_chats)
+    cols = (("24h", "24ч"), ("7d", "7дн"), ("30d", "30дн"), ("all", "всего"))
+    lines = [f"{'':<26}" + "".join(f"{title:>7}" for _, title in cols)]
+    for event, label in stats.EVENTS.items():
+        lines.append(f"{label:<26}" + "".join(f"{windows[key].get(event, 0):>7}" for key, _ in cols))
+    text = (
+        "<b>📊 Статистика бота</b>\n"
+        f"Привязано клиентов сейчас: <b>{linked}</b>\n"
+        f"Сегодня отбивок: <b>{windows['today'].get('confirmation_sent', 0)}</b>\n\n"
+        f"<pre>{escape_html(chr(10).join(lines))}</pre>"
+    )
+    await send_message(chat_id, text, parse_mode="HTML")
+
+# ------------------- /find /record /chat (только админ) -------------------
+# Ответы строятся по индексам lookup_index (без чтения JSON на каждый запрос).
+# Листание страниц и переходы между карточками — callback'и "adm:...",
+# сообщение при этом редактируется на месте.
+ADMIN_PAGE_SIZE = 8
+
+ADMIN_USAGE = (
+    "<b>Поиск</b>\n"
+    "/find &lt;телефон или его начало&gt; — кто привязал номер\n"
+    "/chat &lt;chat_id&gt; — номер, шаг диалога и отбивки чата\n"
+    "/record &lt;id записи&gt; — что по записи уже отправлено"
+)
 
-    # record_id может быть в resource_id, либо в data.id
-    record_id = payload.get("resource_id") or d.get("id") or d.get("record_id") or d.get("appointment_id") or d.get("event_id")
-    record_id = safe_str(record_id)
+def _nav_row(callback_prefix: str, page: int, total: int) -> list:
+    pages = (total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE
+    if pages <= 1:
+        return []
+    row = []
+    if page > 0:
+        row.append({"text": "◀️", "callback_data": f"{callback_prefix}:{page - 1}"})
+    row.append({"text": f"{page + 1}/{pages}", "callback_data": "adm:noop"})
+    if page < pages - 1:
+        row.append({"text": "▶️", "callback_data": f"{callback_prefix}:{page + 1}"})
+    return [row]
+
+def render_find(prefix: str, page: int) -> tuple[str, dict | None]:
+    items, total = lookup_index.find(prefix, page * ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE)
+    if total == 0:
+        return f"🔎 Нет привязанных номеров на <code>+{escape_html(prefix)}</code>", None
+    lines = [f"<b>🔎 Номера на +{escape_html(prefix)}</b>: {total}"]
+    rows = []
+    for digits, chat_ids in items:
+        lines.append(f"<code>+{digits}</code> → " + ", ".join(f"<code>{c}</code>" for c in chat_ids))
+        for c in chat_ids:
+            rows.append([{"text": f"+{digits} · чат {c}", "callback_data": f"adm:chat:{c}:0"}])
+    return "\n".join(lines), inline_keyboard(rows + _nav_row(f"adm:find:{prefix}", page, total))
+
+def render_chat(chat_id: int, page: int) -> tuple[str, dict | None]:
+    st = lookup_index.chat(chat_id)
+    record_ids = lookup_index.chat_record_ids(chat_id)
+    if st is None and not record_ids:
+        return f"💬 Чат <code>{chat_id}</code> не найден", None
+    st = st or {"step": "—", "phone": ""}
+    text = (
+        f"<b>💬 Чат</b> <code>{chat_id}</code>\n"
+        f"тел: <code>{escape_html(st['phone'] or '—')}</code>\n"
+        f"шаг: {escape_html(st['step'])}\n"
+        f"записей с отбивками: <b>{len(record_ids)}</b>"
+    )
+    rows = []
+    for record_id in record_ids[page * ADMIN_PAGE_SIZE:(page + 1) * ADMIN_PAGE_SIZE]:
+        kinds = lookup_index.record(record_id) or {}
+        ts = max((safe_str(x.get("ts")) for x in kinds.values() if isinstance(x, dict)), default="")
+        label = f"📄 {record_id}" + (f" · {ts[:16].replace('T', ' ')}" if ts else "")
+        rows.append([{"text": label, "callback_data": f"adm:rec:{record_id}"}])
+    return text, inline_keyboard(rows + _nav_row(f"adm:chat:{chat_id}", page, len(record_ids))) if rows else None
+
+def render_record(record_id: str) -> tuple[str, dict | None]:
+    kinds = lookup_index.record(record_id)
+    if not kinds:
+        return f"📄 По записи <code>{escape_html(record_id)}</code> ничего не отправляли", None
+    lines = [f"<b>📄 Запись</b> <code>{escape_html(record_id)}</code>"]
+    chat_ids: list[int] = []
+    for kind, extra in kinds.items():
+        if not isinstance(extra, dict):
+            lines.append(f"• {escape_html(kind)}: отправлено")
+            continue
+        lines.append(
+            f"• {escape_html(kind)}: {escape_html(safe_str(extra.get('ts'))[:19].replace('T', ' '))} "
+            f"({escape_html(safe_str(extra.get('src')) or '—')}), "
+            f"тел <code>{escape_html(safe_str(extra.get('phone')) or '—')}</code>, "
+            f"чат <code>{escape_html(safe_str(extra.get('chat_id')) or '—')}</code>"
+        )
+        candidates = lookup_index.chats_for_phone(safe_str(extra.get("phone")))
+        try:
+            candidates.insert(0, int(extra.get("chat_id")))
+        except Exception:
+            pass
+        for c in candidates:
+            if c not in chat_ids:
+                chat_ids.append(c)
+    rows = [[{"text": f"💬 Чат {c}", "callback_data": f"adm:chat:{c}:0"}] for c in chat_ids]
+    return "\n".join(lines), inline_keyboard(rows) if rows else None
+
+async def send_admin_view(chat_id: int, view: tuple[str, dict | None], message_id: int | None = None):
+    text, markup = view
+    if message_id is None:
+        return await send_message(chat_id, text, reply_markup=markup, parse_mode="HTML")
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
+    if markup:
+        payload["reply_markup"] = markup
+    return await tg_post("editMessageText", payload)
+
+async def handle_admin_command(chat_id: int, text: str) -> bool:
+    """/find, /chat, /record. False — если это не наша команда."""
+    parts = text.split(maxsplit=1)
+    cmd = parts[0].split("@", 1)[0].lower()
+    arg = parts[1].strip() if len(parts) > 1 else ""
+
+    if cmd == "/find":
+        prefix = phone_prefix(arg)
+        if arg and not prefix:
+            await send_message(chat_id, ADMIN_USAGE, parse_mode="HTML")
+        else:
+            await send_admin_view(chat_id, render_find(prefix, 0))
+    elif cmd == "/chat":
+        try:
+            await send_admin_view(chat_id, render_chat(int(arg), 0))
+        except ValueError:
+            await send_message(chat_id, ADMIN_USAGE, parse_mode="HTML")
+    elif cmd == "/record":
+        if arg:
+            await send_admin_view(chat_id, render_record(arg))
+        else:
+            await send_message(chat_id, ADMIN_USAGE, parse_mode="HTML")
+    else:
+        return False
+    return True
 
-    # company_id может отличаться от env — берём из payload если есть
-    company_id = payload.get("company_id") or d.get("company_id") or YCLIENTS_COMPANY_ID
+async def handle_admin_callback(chat_id: int, message_id: int | None, data: str):
+    parts = data.split(":")
     try:
-        company_id = int(company_id)
-    except Exception:
-        company_id = int(YCLIENTS_COMPANY_ID)
-
-    # телефон (часто отсутствует)
-    phone_raw = None
-    if isinstance(d.get("client"), dict):
-        phone_raw = d["client"].get("phone") or d["client"].get("phone_number")
-    phone_raw = phone_raw or d.get("phone") or d.get("client_phone")
-    phone = normalize_phone(safe_str(phone_raw)) or safe_str(phone_raw)
-
-    # дата/время в webhook чаще приходит как "date"
-    start_str = d.get("start_at") or d.get("datetime") or d.get("date_time") or d.get("seance_date") or d.get("date")
-    start_dt = try_parse_dt(start_str) if start_str else None
-
-    return {
-        "status": status,
-        "record_id": record_id,
-        "company_id": company_id,
-        "phone": phone,
-        "start_dt": start_dt,
-        "raw": payload,
-    }
-
-def extract_from_record_detail(rec: dict) -> dict:
-    """Вынимаем из полной записи телефон/услугу/мастера/стоимость/дату."""
-    phone_raw = None
-    if isinstance(rec.get("client"), dict):
-        phone_raw = rec["client"].get("phone") or rec["client"].get("phone_number")
-    phone_raw = phone_raw or rec.get("client_phone") or rec.get("phone")
-    phone = normalize_phone(safe_str(phone_raw)) or safe_str(phone_raw)
-
-    # datetime
-    start_str = rec.get("datetime") or rec.get("date") or rec.get("start_at")
-    start_dt = try_parse_dt(start_str) if start_str else None
-
-    # service/title
-    service = ""
-    price = ""
-
-    if isinstance(rec.get("services"), list) and rec["services"]:
-        s0 = rec["services"][0]
-        if isinstance(s0, dict):
-            service = s0.get("title") or s0.get("name") or ""
-            if s0.get("price") is not None:
-                price = safe_str(s0.get("price"))
-
-    if not service and isinstance(rec.get("service"), dict):
-        service = rec["service"].get("title") or rec["service"].get("name") or service
-        if not price and rec["service"].get("price") is not None:
-            price = safe_str(rec["service"].get("price"))
-
-    if not price:
-        price = safe_str(rec.get("price") or rec.get("cost") or rec.get("amount") or "")
-
-    master = ""
-    if isinstance(rec.get("staff"), dict):
-        master = rec["staff"].get("name") or master
-    if isinstance(rec.get("master"), dict):
-        master = rec["master"].get("name") or master
-
-    return {
-        "phone": phone,
-        "start_dt": start_dt,
-        "service": safe_str(service),
-        "master": safe_str(master),
-        "price": safe_str(price),
-    }
+        if parts[1] == "find":
+            view = render_find(parts[2], int(parts[3]))
+        elif parts[1] == "chat":
+            view = render_chat(int(parts[2]), int(parts[3]))
+        elif parts[1] == "rec":
+            # карточку записи шлём новым сообщением — список чата остаётся, к нему можно вернуться
+            await send_admin_view(chat_id, render_record(":".join(parts[2:])))
+            return
+        else:
+            return
+    except (IndexError, ValueError):
+        logger.warning(f"Кривой admin callback: {data}")
+        return
+    await send_admin_view(chat_id, view, message_id)
 
+# ------------------- YCLIENTS WEBHOOK -------------------
 @app.post("/yclients-webhook")
 async def yclients_webhook(request: Request):
     # секрет можно передавать query или заголовком (на всякий случай)
@@ -345,62 +628,84 @@ async def yclients_webhook(request: Request):
 
     payload = await request.json()
     logger.info(f"YCLIENTS webhook: {payload}")
+    capture.capture_inbound(request.url.path, dict(request.query_params), dict(request.headers), payload)
 
-    f = extract_from_yclients_webhook(payload)
+    details = extract_webhook(payload)
 
     # нас интересует отбивка в момент создания записи
     create_statuses = {"create", "created", "new"}
-    if f["status"] and (f["status"] not in create_statuses):
+    if details.status and (details.status not in create_statuses):
         # игнорим update/delete чтобы не слать лишнее
         return {"ok": True}
 
-    record_id = f["record_id"]
-    company_id = f["company_id"]
+    record_id = details.record_id
+    company_id = details.company_id
 
     if record_id and was_sent(record_id, "created"):
         return {"ok": True}
 
+    stats.incr("booking_webhook")
+
+    # услугу/мастера/цену берём по id из локального кэша справочников — без запросов к API
+    await ensure_reference_data(company_id)
+    d = payload.get("data") if isinstance(payload.get("data"), dict) else payload
+    details.merge(Booking(**resolve_record_refs(company_id, d)))
+
     # если нет телефона в webhook — достаем полную запись по id
-    details = {"phone": f["phone"], "start_dt": f["start_dt"], "service": "", "master": "", "price": ""}
-    if not details["phone"]:
-        rec = await get_record_by_id(company_id, record_id)
+    unavailable = False
+    if not details.phone:
+        try:
+            rec = await get_record_by_id(company_id, record_id)
+        except YClientsUnavailable as e:
+            logger.warning(f"get_record_by_id: YCLIENTS недоступен ({e})")
+            capture.capture_upstream("record_unavailable", record_id, str(e))
+            unavailable = True
+            rec = None
+        else:
+            capture.capture_upstream("record", record_id, rec)
         if rec:
-            det = extract_from_record_detail(rec)
-            details.update(det)
+            details.merge(extract_record(rec))
 
-    if not details["phone"]:
+    if not details.phone:
+        reason = (
+            "YCLIENTS недоступен — детали записи недоступны."
+            if unavailable
+            else "Не нашла телефон (ни в webhook, ни в деталях записи)."
+        )
         await notify_admin(
             f"<b>YCLIENTS webhook</b><br/>"
             f"record_id: <code>{escape_html(record_id)}</code><br/>"
-            f"Не нашла телефон (ни в webhook, ни в деталях записи).<br/>"
+            f"{reason}<br/>"
             f"<pre>{escape_html(json.dumps(payload, ensure_ascii=False)[:1500])}</pre>"
         )
+        stats.incr("booking_no_phone")
         return {"ok": True}
 
     phone_map = phone_to_chat_map()
-    chat_id = phone_map.get(str(details["phone"]))
+    chat_id = phone_map.get(str(details.phone))
 
     if not chat_id:
         await notify_admin(
             f"<b>Новая запись (YCLIENTS)</b><br/>"
             f"record_id: <code>{escape_html(record_id)}</code><br/>"
-            f"Телефон: <code>{escape_html(details['phone'])}</code><br/>"
+            f"Телефон: <code>{escape_html(details.phone)}</code><br/>"
             f"Клиент не привязан к боту (не отправлял номер)."
         )
+        stats.incr("booking_unlinked")
         return {"ok": True}
 
     # формируем текст
-    if details["start_dt"]:
-        dt_line = f"Дата и время визита: {details['start_dt'].strftime('%d.%m.%Y %H:%M')}"
+    if details.start_dt:
+        dt_line = f"Дата и время визита: {details.start_dt.strftime('%d.%m.%Y %H:%M')}"
     else:
         dt_line = "Дата и время визита: уточните у администратора"
 
     # динамические поля санитайзим, чтобы не ломали Markdown
-    service_txt = md_sanitize(details["service"] or "УСЛУГА")
-    master_name = md_sanitize(details["master"]) if details["master"] else ""
+    service_txt = md_sanitize(details.service or "УСЛУГА")
+    master_name = md_sanitize(details.master) if details.master else ""
     master_txt = master_name if master_name else "*к какому Mастеру*"
 
-    price_val = md_sanitize(details["price"]) if details["price"] else ""
+    price_val = md_sanitize(details.price) if details.price else ""
     price_txt = f"Предварительная cтoимoсть: {price_val}" if price_val else "Предварительная cтoимoсть: —"
 
     msg = tpl_booking_created(
@@ -410,27 +715,105 @@ async def yclients_webhook(request: Request):
         dt_str=dt_line,
     )
     await send_client(chat_id, msg, meta="BOOKING_CREATED_WEBHOOK")
+    stats.incr("confirmation_sent")
 
     if record_id:
-        mark_sent(record_id, "created", {"src": "webhook", "ts": datetime.utcnow().isoformat(), "phone": details["phone"], "chat_id": chat_id})
+        mark_sent(record_id, "created", {"src": "webhook", "ts": datetime.utcnow().isoformat(), "phone": details.phone, "chat_id": chat_id})
 
     await notify_admin(
         f"<b>✅ Отбивка отправлена</b><br/>"
         f"chat_id: <code>{chat_id}</code><br/>"
-        f"тел: <code>{escape_html(details['phone'])}</code><br/>"
+        f"тел: <code>{escape_html(details.phone)}</code><br/>"
         f"record_id: <code>{escape_html(record_id)}</code>"
     )
     return {"ok": True}
 
+# ------------------- BACKFILL: ЗАПИСИ, СДЕЛАННЫЕ ДО ПРИВЯЗКИ -------------------
+# Клиент мог записаться раньше, чем привязал номер, — отбивка по таким записям
+# не ушла. После привязки ищем его будущие записи и шлём одно сводное сообщение.
+BACKFILL_COOLDOWN = 600  # повторная привязка того же чата чаще — не дёргаем YCLIENTS
+_last_backfill: dict[int, float] = {}
+
+def schedule_backfill(chat_id: int, phone: str):
+    if not phone.startswith("+"):
+        return
+    now = time.monotonic()
+    if now - _last_backfill.get(chat_id, -BACKFILL_COOLDOWN) < BACKFILL_COOLDOWN:
+        return
+    _last_backfill[chat_id] = now
+    lifecycle.spawn(
+        backfill_upcoming(chat_id, phone),
+        job={"kind": "backfill", "params": {"chat_id": chat_id, "phone": phone}},
+    )
+
+def tpl_upcoming_visits(lines: list[str]) -> str:
+    return (
+        "📅 Ваши ближайшие визиты в\n"
+        "Studio KUTIKULA\n\n"
+        + "\n\n".join(lines)
+        + f"\n\n{ADDRESS_BLOCK}\n\n"
+        "Ждём Bаc!"
+    )
+
+async def backfill_upcoming(chat_id: int, phone: str):
+    company_id = int(YCLIENTS_COMPANY_ID)
+    # время записей в YCLIENTS — местное время студии, сравниваем с ним же (как в stats)
+    now = stats.local_now()
+    try:
+        await ensure_reference_data(company_id)
+        client_ids = await find_client_ids_by_phone(company_id, phone)
+        # записи по всем карточкам клиента — параллельно, ограничение внутри yclients_api
+        batches = await asyncio.gather(*(get_upcoming_records(company_id, cid, now) for cid in client_ids))
+    except YClientsUnavailable as e:
+        logger.warning(f"backfill {chat_id}: YCLIENTS недоступен ({e})")
+        return
+
+    visits = {}
+    for rec in (r for batch in batches for r in batch):
+        record_id = safe_str(rec.get("id"))
+        if not record_id or record_id in visits or was_sent(record_id, "created"):
+            continue
+        visit = Booking(**resolve_record_refs(company_id, rec))
+        visit.merge(extract_record(rec))
+        if not visit.start_dt or visit.start_dt < now:
+            continue
+        visits[record_id] = visit
+
+    if not visits:
+        return
+
+    ordered = sorted(visits.items(), key=lambda kv: kv[1].start_dt)
+    lines = []
+    for _, v in ordered:
+        line = f"▫️{md_sanitize(v.service or 'УСЛУГА')}\n{v.start_dt.strftime('%d.%m.%Y %H:%M')}"
+        if v.master:
+            line += f"\n{md_sanitize(v.master)}"
+        if v.price:
+            line += f"\nПредварительная cтoимoсть: {md_sanitize(v.price)}"
+        lines.append(line)
+
+    await send_client(chat_id, tpl_upcoming_visits(lines), meta="BACKFILL_UPCOMING")
+    ts = datetime.utcnow().isoformat()
+    for record_id, _ in ordered:
+        mark_sent(record_id, "created", {"src": "backfill", "ts": ts, "phone": phone, "chat_id": chat_id})
+    stats.incr("backfill_visits", len(ordered))
+
+JOB_HANDLERS["backfill"] = backfill_upcoming
+
 # ------------------- TELEGRAM WEBHOOK -------------------
 @app.get("/")
 async def root():
     return {"status": "ok"}
 
+@app.get("/health/yclients")
+async def health_yclients():
+    return {"degraded": is_degraded(), **breaker_states()}
+
 @app.post("/telegram-webhook")
 async def telegram_webhook(request: Request):
     update = await request.json()
     logger.info(f"Incoming update: {update}")
+    capture.capture_inbound(request.url.path, dict(request.query_params), dict(request.headers), update)
 
     # callback-кнопки
     if "callback_query" in update:
@@ -443,6 +826,10 @@ async def telegram_webhook(request: Request):
 
         await tg_post("answerCallbackQuery", {"callback_query_id": cq_id})
 
+        if data.startswith("adm:") and is_admin_chat(chat_id):
+            await handle_admin_callback(chat_id, msg.get("message_id"), data)
+            return JSONResponse(content={"ok": True})
+
         if data.startswith("menu:"):
             action = data.split(":", 1)[1]
             if action == "to_admin":
@@ -486,6 +873,13 @@ async def telegram_webhook(request: Request):
         await send_chatid(chat_id)
         return JSONResponse(content={"ok": True})
 
+    if text.startswith("/stats") and is_admin_chat(chat_id):
+        await send_stats(chat_id)
+        return JSONResponse(content={"ok": True})
+
+    if text.startswith("/") and is_admin_chat(chat_id) and await handle_admin_command(chat_id, text):
+        return JSONResponse(content={"ok": True})
+
     # контакт (кнопка «Отправить номер»)
     contact = message.get("contact")
     if contact:
@@ -503,6 +897,7 @@ async def telegram_webhook(request: Request):
             f"тел: <code>{escape_html(phone)}</code>"
         )
         await send_client(chat_id, "Спасибо! Номер сохранён.", reply_markup=main_menu(), meta="CONTACT_SAVED")
+        schedule_backfill(chat_id, phone)
         return JSONResponse(content={"ok": True})
 
     # приветствия + /start
@@ -521,6 +916,7 @@ async def telegram_webhook(request: Request):
             f"<b>📱 Клиент прислал номер текстом</b><br/>chat_id: <code>{chat_id}</code><br/>тел: <code>{escape_html(ph)}</code>"
         )
         await send_client(chat_id, "Спасибо! Номер сохранён.", reply_markup=main_menu(), meta="PHONE_SAVED_TEXT")
+        schedule_backfill(chat_id, ph)
         return JSONResponse(content={"ok": True})
 
     # режим передачи админу
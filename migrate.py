@@ -0,0 +1,388 @@
+"""
+Перенос dialog_memory.json и sent_events.json в базу (таблицы users, dialog_state, sent_events).
+
+    DATABASE_URL=postgres://... python migrate.py
+    python migrate.py --verify-only
+
+Файлы читаются потоком (целиком в память не грузятся), строки проверяются и
+нормализуются, пишутся пачками upsert'ов в транзакциях по несколько пачек.
+После каждой транзакции в migrate_checkpoint.json сохраняется позиция в файле —
+прерванную миграцию можно просто запустить ещё раз, повторный прогон ничего не
+задвоит. Бот переписывает эти файлы целиком, поэтому вместе с позицией
+запоминаем, какой это был файл (inode, размер, mtime): если файл с тех пор
+поменялся, позиция в нём ничего не значит и источник переносится заново.
+В конце сверяем количество строк и контрольные суммы с базой.
+"""
+import os
+import re
+import sys
+import json
+import codecs
+import asyncio
+import hashlib
+import logging
+import argparse
+from typing import Any, Iterator
+
+from booking_extract import normalize_phone
+
+logger = logging.getLogger("migrate")
+
+CHECKPOINT_FILE = "migrate_checkpoint.json"
+# те же файлы, что у бота (main.MEMORY_FILE / main.SENT_FILE); main не импортируем — он тянет FastAPI
+MEMORY_FILE = "dialog_memory.json"
+SENT_FILE = "sent_events.json"
+CHUNK_SIZE = 1 << 16
+
+_WS_RE = re.compile(r"[ \t\r\n]*")
+
+
+class _Incomplete(Exception):
+    pass
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+# ------------------- ПОТОКОВОЕ ЧТЕНИЕ JSON -------------------
+def iter_json_object(path: str, start_offset: int = 0, chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[str, Any, int]]:
+    """
+    Потоково отдаёт пары верхнего уровня {"key": value, ...} как (key, value, offset),
+    где offset — позиция в байтах сразу после value (с неё можно продолжить).
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buf = ""
+        pos = 0
+        offset = start_offset  # байтовая позиция buf[pos] в файле
+        eof = False
+        state = "start" if start_offset == 0 else "after_value"
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + utf8.decode(chunk, final=eof)
+            pos = 0
+
+        def advance(new_pos: int):
+            nonlocal pos, offset
+            offset += len(buf[pos:new_pos].encode("utf-8"))
+            pos = new_pos
+
+        while True:
+            advance(_WS_RE.match(buf, pos).end())
+            if pos >= len(buf):
+                if eof:
+                    raise ValueError(f"{path}: файл оборвался (байт {offset})")
+                fill()
+                continue
+
+            ch = buf[pos]
+            if state == "start":
+                if ch != "{":
+                    raise ValueError(f"{path}: ожидался объект JSON")
+                advance(pos + 1)
+                state = "key_or_end"
+                continue
+            if state in ("after_value", "key_or_end") and ch == "}":
+                return
+            if state == "after_value":
+                if ch != ",":
+                    raise ValueError(f"{path}: ожидалась ',' (байт {offset})")
+                advance(pos + 1)
+                state = "key"
+                continue
+
+            # ключ : значение — разбираем целиком или дочитываем файл и пробуем снова
+            try:
+                key, p = decoder.raw_decode(buf, pos)
+                p = _WS_RE.match(buf, p).end()
+                if p >= len(buf):
+                    raise _Incomplete
+                if buf[p] != ":":
+                    raise ValueError(f"{path}: ожидалось ':' (байт {offset})")
+                p = _WS_RE.match(buf, p + 1).end()
+                value, p = decoder.raw_decode(buf, p)
+                # значение (например, число) могло быть обрезано концом буфера
+                if _WS_RE.match(buf, p).end() >= len(buf) and not eof:
+                    raise _Incomplete
+            except (json.JSONDecodeError, _Incomplete):
+                if eof:
+                    raise ValueError(f"{path}: битый JSON около байта {offset}")
+                fill()
+                continue
+
+            advance(p)
+            state = "after_value"
+            yield str(key), value, offset
+
+
+# ------------------- НОРМАЛИЗАЦИЯ -------------------
+def dialog_rows(key: str, value: Any) -> list[tuple[str, dict]]:
+    """dialog_memory.json: chat_id -> {"step": ..., "data": {"phone": ...}}"""
+    try:
+        tg_id = int(key)
+    except Exception:
+        raise InvalidRow(f"chat_id не число: {key!r}")
+    if not isinstance(value, dict):
+        raise InvalidRow(f"{key}: состояние не объект")
+
+    step = str(value.get("step") or "idle")[:64]
+    data = value.get("data") if isinstance(value.get("data"), dict) else {}
+    phone = None
+    if data.get("phone"):
+        raw = str(data["phone"])
+        phone = (normalize_phone(raw) or raw)[:64]
+        data = {**data, "phone": phone}
+
+    return [
+        ("users", {"tg_id": tg_id, "phone": phone}),
+        ("dialog_state", {"tg_id": tg_id, "step": step, "payload": json.dumps(data, ensure_ascii=False, sort_keys=True)}),
+    ]
+
+
+def sent_rows(key: str, value: Any) -> list[tuple[str, dict]]:
+    """sent_events.json: record_id -> {kind: extra | true}"""
+    record_id = key.strip()
+    if not record_id or len(record_id) > 64:
+        raise InvalidRow(f"плохой record_id: {key!r}")
+    if not isinstance(value, dict):
+        raise InvalidRow(f"{key}: события не объект")
+    rows = []
+    for kind, extra in value.items():
+        if not extra:
+            continue
+        rows.append(("sent_events", {
+            "record_id": record_id,
+            "kind": str(kind)[:32],
+            "payload": json.dumps(extra, ensure_ascii=False, sort_keys=True),
+        }))
+    return rows
+
+
+# таблица -> (ключ конфликта, обновляемые колонки, каноническая строка для контрольной суммы)
+TABLES = {
+    "users": (("tg_id",), ("phone",), lambda r: f"{r['tg_id']}|{r['phone'] or ''}"),
+    "dialog_state": (("tg_id",), ("step", "payload"), lambda r: f"{r['tg_id']}|{r['step']}|{r['payload']}"),
+    "sent_events": (("record_id", "kind"), ("payload",), lambda r: f"{r['record_id']}|{r['kind']}|{r['payload']}"),
+}
+
+SOURCES = {
+    "memory": dialog_rows,
+    "sent": sent_rows,
+}
+
+
+def _row_hash(s: str) -> int:
+    return int.from_bytes(hashlib.sha256(s.encode("utf-8")).digest()[:8], "big")
+
+
+def _add_stats(acc: dict, table: str, row: dict):
+    st = acc.setdefault(table, {"count": 0, "checksum": 0})
+    st["count"] += 1
+    # сумма по модулю 2^64 не зависит от порядка строк — так же считаем и по базе
+    st["checksum"] = (st["checksum"] + _row_hash(TABLES[table][2](row))) % (1 << 64)
+
+
+# ------------------- CHECKPOINT -------------------
+def load_checkpoint() -> dict:
+    try:
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        return d if isinstance(d, dict) else {}
+    except Exception:
+        return {}
+
+
+def save_checkpoint(ckpt: dict):
+    tmp = CHECKPOINT_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(ckpt, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, CHECKPOINT_FILE)
+
+
+def file_identity(path: str) -> dict:
+    st = os.stat(path)
+    return {"ino": st.st_ino, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+# ------------------- ЗАПИСЬ В БАЗУ -------------------
+def _upsert_stmt(models: dict, dialect: str, table: str, rows: list[dict]):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise SystemExit(f"upsert для {dialect} не поддерживается")
+    keys, update_cols, _ = TABLES[table]
+    stmt = insert(models[table]).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={c: getattr(stmt.excluded, c) for c in update_cols},
+    )
+
+
+async def migrate_source(source: str, path: str, ckpt: dict, batch_size: int, tx_batches: int):
+    from db import SessionLocal, engine, User, DialogState, SentEvent
+
+    models = {"users": User, "dialog_state": DialogState, "sent_events": SentEvent}
+    dialect = engine.dialect.name
+    to_rows = SOURCES[source]
+
+    st = ckpt.setdefault(source, {"path": path, "file": None, "offset": 0, "done": False, "entries": 0, "rejected": 0, "tables": {}})
+    if not os.path.exists(path):
+        if not st["done"]:
+            logger.info(f"{path}: нет файла, пропускаю")
+            st["done"] = True
+            save_checkpoint(ckpt)
+        return
+    # идентичность снимаем до чтения: если файл подменят посреди прогона,
+    # в следующий раз она не совпадёт и источник перенесётся заново (безопасная сторона)
+    ident = file_identity(path)
+    if (st["offset"] or st["done"]) and st.get("file") != ident:
+        logger.warning(f"{path}: файл изменился после прошлого запуска — переношу его заново")
+        st.update({"offset": 0, "done": False, "entries": 0, "rejected": 0, "tables": {}})
+    st["path"] = path
+    st["file"] = ident
+    if st["done"]:
+        logger.info(f"{path}: уже перенесён, пропускаю")
+        return
+
+    pending: dict[str, list[dict]] = {}
+    pending_stats: dict = {}
+    pending_entries = 0
+    pending_rejected = 0
+    batches_in_tx = 0
+    last_offset = st["offset"]
+
+    session = SessionLocal()
+    tx = await session.begin()
+
+    async def flush_batch():
+        nonlocal pending, batches_in_tx
+        for table, rows in pending.items():
+            if rows:
+                await session.execute(_upsert_stmt(models, dialect, table, rows))
+        pending = {}
+        batches_in_tx += 1
+
+    async def commit():
+        nonlocal tx, pending_stats, pending_entries, pending_rejected, batches_in_tx
+        await tx.commit()
+        # checkpoint — только после коммита: при падении повторим максимум одну транзакцию
+        # (upsert'ы это переживут; если упали ровно между коммитом и записью checkpoint,
+        # сверка покажет лишние строки в источнике — тогда запустить с --restart)
+        st["offset"] = last_offset
+        st["entries"] += pending_entries
+        st["rejected"] += pending_rejected
+        for table, acc in pending_stats.items():
+            t = st["tables"].setdefault(table, {"count": 0, "checksum": 0})
+            t["count"] += acc["count"]
+            t["checksum"] = (t["checksum"] + acc["checksum"]) % (1 << 64)
+        save_checkpoint(ckpt)
+        logger.info(f"{path}: {st['entries']} записей, байт {last_offset}")
+        pending_stats, pending_entries, pending_rejected, batches_in_tx = {}, 0, 0, 0
+        tx = await session.begin()
+
+    try:
+        in_batch = 0
+        for key, value, offset in iter_json_object(path, st["offset"]):
+            last_offset = offset
+            try:
+                rows = to_rows(key, value)
+            except InvalidRow as e:
+                logger.warning(f"{path}: пропускаю — {e}")
+                pending_rejected += 1
+                continue
+            for table, row in rows:
+                pending.setdefault(table, []).append(row)
+                _add_stats(pending_stats, table, row)
+            pending_entries += 1
+            in_batch += 1
+            if in_batch >= batch_size:
+                await flush_batch()
+                in_batch = 0
+                if batches_in_tx >= tx_batches:
+                    await commit()
+        await flush_batch()
+        st["done"] = True
+        await commit()
+        await tx.rollback()  # пустая транзакция, открытая последним commit()
+    except BaseException:
+        await tx.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+# ------------------- ПРОВЕРКА -------------------
+async def verify(ckpt: dict) -> bool:
+    from sqlalchemy import select
+    from db import SessionLocal, User, DialogState, SentEvent
+
+    columns = {
+        "users": (User.tg_id, User.phone),
+        "dialog_state": (DialogState.tg_id, DialogState.step, DialogState.payload),
+        "sent_events": (SentEvent.record_id, SentEvent.kind, SentEvent.payload),
+    }
+    expected: dict = {}
+    for st in ckpt.values():
+        for table, acc in (st.get("tables") or {}).items():
+            e = expected.setdefault(table, {"count": 0, "checksum": 0})
+            e["count"] += acc["count"]
+            e["checksum"] = (e["checksum"] + acc["checksum"]) % (1 << 64)
+
+    ok = True
+    async with SessionLocal() as session:
+        for table, cols in columns.items():
+            got = {}
+            result = await session.stream(select(*cols))
+            async for row in result:
+                _add_stats(got, table, dict(row._mapping))
+            got = got.get(table, {"count": 0, "checksum": 0})
+            exp = expected.get(table, {"count": 0, "checksum": 0})
+            same = got == exp
+            ok = ok and same
+            logger.info(
+                f"{table}: источник {exp['count']} строк / {exp['checksum']:016x}, "
+                f"база {got['count']} строк / {got['checksum']:016x} — {'OK' if same else 'РАСХОЖДЕНИЕ'}"
+            )
+    return ok
+
+
+async def run(args) -> int:
+    if not os.getenv("DATABASE_URL"):
+        logger.error("Не задан DATABASE_URL")
+        return 2
+    from db import init_db
+
+    await init_db()
+    ckpt = {} if args.restart else load_checkpoint()
+    if not args.verify_only:
+        await migrate_source("memory", args.memory, ckpt, args.batch, args.tx_batches)
+        await migrate_source("sent", args.sent, ckpt, args.batch, args.tx_batches)
+        for source in ("memory", "sent"):
+            st = ckpt.get(source, {})
+            logger.info(f"{st.get('path')}: перенесено {st.get('entries', 0)}, отброшено {st.get('rejected', 0)}")
+    return 0 if await verify(ckpt) else 1
+
+
+def cli():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Миграция JSON-хранилищ бота в базу")
+    parser.add_argument("--memory", default=MEMORY_FILE)
+    parser.add_argument("--sent", default=SENT_FILE)
+    parser.add_argument("--batch", type=int, default=1000, help="записей в одном upsert")
+    parser.add_argument("--tx-batches", type=int, default=10, help="пачек в одной транзакции")
+    parser.add_argument("--restart", action="store_true", help="игнорировать checkpoint и начать сначала")
+    parser.add_argument("--verify-only", action="store_true", help="только сверить базу с checkpoint")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,290 @@
+"""
+Офлайн-прогон журнала, записанного capture.py (WEBHOOK_CAPTURE_DIR), через приложение.
+
+    python replay.py captures/ --speed 10 --state dialog_memory.json --sent sent_events.json
+
+Telegram и YCLIENTS подменяются заглушками: исходящие сообщения собираются
+и сравниваются с тем, что бот реально отправил при записи журнала,
+ответы YCLIENTS (get_record_by_id) и снимки справочников мастеров/услуг
+берутся из того же журнала. Если журнал писался с редакцией PII, телефоны в
+--state/--sent подменяются так же, как в журнале, иначе привязки не совпадут.
+--speed 1 — исходный темп, N — в N раз быстрее, 0 — без пауз (последовательно).
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import shutil
+import asyncio
+import difflib
+import argparse
+import tempfile
+import contextvars
+from urllib.parse import urlencode
+
+import capture
+
+_replay_id: contextvars.ContextVar[str] = contextvars.ContextVar("replay_request_id", default="")
+
+
+def _out_key(method: str, payload: dict) -> str:
+    """Сравниваем только то, что видит получатель: метод, чат, текст, клавиатура."""
+    payload = payload or {}
+    return json.dumps(
+        {
+            "method": method,
+            "chat_id": payload.get("chat_id"),
+            "text": payload.get("text"),
+            "reply_markup": payload.get("reply_markup"),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+
+
+def _is_refdata(e: dict) -> bool:
+    return e.get("t") == "yc" and e.get("kind") == "refdata"
+
+
+def load_expectations(segments: list[str]) -> tuple[dict, dict, dict]:
+    """
+    Первый проход: исходящие сообщения и ответы YCLIENTS по id входящего запроса,
+    плюс самый ранний снимок каждого справочника (его подкладываем до старта).
+    """
+    outbound: dict[str, list[str]] = {}
+    upstream: dict[tuple[str, str], object] = {}
+    refdata: dict[str, tuple[float, object]] = {}
+    for seg in segments:
+        for e in capture.iter_segment(seg):
+            if e.get("t") == "out":
+                outbound.setdefault(e.get("id", ""), []).append(_out_key(e.get("method", ""), e.get("payload")))
+            elif _is_refdata(e):
+                key, ts = e.get("key", ""), e.get("ts", 0)
+                if key not in refdata or ts < refdata[key][0]:
+                    refdata[key] = (ts, e.get("result"))
+            elif e.get("t") == "yc":
+                upstream[(e.get("kind", ""), e.get("key", ""))] = e.get("result")
+    return outbound, upstream, {key: result for key, (_, result) in refdata.items()}
+
+
+def iter_timeline(segments: list[str]):
+    """
+    Второй проход: входящие запросы и обновления справочников потоком, в порядке
+    времени (сегменты разных воркеров сливаем).
+    """
+    streams = [(e for e in capture.iter_segment(seg) if e.get("t") == "in" or _is_refdata(e)) for seg in segments]
+    return heapq.merge(*streams, key=lambda e: e.get("ts", 0))
+
+
+def load_refdata(yclients_api, key: str, items) -> bool:
+    """key вида "staff:530777" -> справочник в кэш yclients_api."""
+    kind, _, company_id = key.partition(":")
+    try:
+        yclients_api.load_reference_snapshot(kind, int(company_id), items if isinstance(items, list) else [])
+    except Exception as e:
+        print(f"Снимок справочника {key} не загружен: {e!r}")
+        return False
+    return True
+
+
+def copy_state(src: str, dst: str):
+    """Копия dialog_memory/sent_events; телефоны — через ту же редакцию, что и в журнале."""
+    if not capture.CAPTURE_REDACT_PII:
+        shutil.copy(src, dst)
+        return
+    with open(src, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with open(dst, "w", encoding="utf-8") as f:
+        json.dump(capture.redact(data), f, ensure_ascii=False, indent=2)
+
+
+async def _asgi_post(app, path: str, query: dict, body: bytes) -> int:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": urlencode(query or {}).encode(),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("replay", 80),
+    }
+    done = asyncio.Event()
+    body_sent = False
+    status = 0
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            done.set()
+
+    await app(scope, receive, send)
+    done.set()
+    return status
+
+
+def _install_stubs(main, upstream: dict, actual: dict):
+    async def tg_post_stub(method: str, payload: dict):
+        # журнал писался через redact() — сравниваем с тем же преобразованием
+        # (иначе, например, 10-значный chat_id в тексте админу «становится» телефоном)
+        actual.setdefault(_replay_id.get(), []).append(_out_key(method, capture.redact(payload)))
+        return {"ok": True, "result": {"message_id": 1}}
+
+    async def get_record_stub(company_id, record_id):
+        if ("record_unavailable", str(record_id)) in upstream:
+            raise main.YClientsUnavailable(upstream[("record_unavailable", str(record_id))])
+        return upstream.get(("record", str(record_id)))
+
+    async def noop(*args, **kwargs):
+        return None
+
+    main.tg_post = tg_post_stub
+    main.get_record_by_id = get_record_stub
+    main.ensure_reference_data = noop
+
+    async def no_clients(*args, **kwargs):
+        return []
+
+    # backfill после привязки номера в журнал не попадает — клиентов в YCLIENTS «нет»
+    main.find_client_ids_by_phone = no_clients
+    # секрет в журнале вырезан — проверку отключаем
+    main.YCLIENTS_WEBHOOK_SECRET = ""
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+async def replay(args) -> int:
+    # дальше работаем из временной папки — пути к журналу делаем абсолютными
+    segments = [os.path.abspath(p) for p in capture.list_segments(args.capture)]
+    if not segments:
+        print(f"Нет сегментов журнала в {args.capture}")
+        return 1
+    expected, upstream, refdata = load_expectations(segments)
+
+    # приложение пишет dialog_memory.json / sent_events.json относительными путями —
+    # работаем во временной папке, чтобы не трогать боевые файлы
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    for src, name in ((args.state, "dialog_memory.json"), (args.sent, "sent_events.json")):
+        if src:
+            copy_state(src, os.path.join(workdir, name))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    capture.CAPTURE_DIR = ""
+    import main
+    import yclients_api
+
+    for key, items in refdata.items():
+        load_refdata(yclients_api, key, items)
+
+    actual: dict[str, list[str]] = {}
+    _install_stubs(main, upstream, actual)
+    if args.admin_chat is not None:
+        main.ADMIN_CHAT_ID = args.admin_chat
+
+    latencies: list[float] = []
+    errors = 0
+    ids: list[str] = []
+
+    async def one(entry: dict):
+        nonlocal errors
+        _replay_id.set(entry.get("id", ""))
+        body = json.dumps(entry.get("body"), ensure_ascii=False).encode("utf-8")
+        t = time.perf_counter()
+        try:
+            status = await _asgi_post(main.app, entry.get("path", "/"), entry.get("query"), body)
+        except Exception as e:
+            print(f"[{entry.get('id')}] исключение: {e!r}")
+            status = 500
+        latencies.append(time.perf_counter() - t)
+        if status != 200:
+            errors += 1
+
+    started = time.perf_counter()
+    first_ts = None
+    tasks = []
+    n = 0
+    for entry in iter_timeline(segments):
+        if _is_refdata(entry):
+            # справочник обновился по ходу журнала — дальше запросы видят новый
+            load_refdata(yclients_api, entry.get("key", ""), entry.get("result"))
+            continue
+        if args.limit and n >= args.limit:
+            break
+        n += 1
+        ids.append(entry.get("id", ""))
+        if args.speed <= 0:
+            await one(entry)
+            continue
+        ts = entry.get("ts", 0)
+        if first_ts is None:
+            first_ts = ts
+        delay = (ts - first_ts) / args.speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(entry)))
+    if tasks:
+        await asyncio.gather(*tasks)
+    wall = time.perf_counter() - started
+
+    diffs = [rid for rid in ids if expected.get(rid, []) != actual.get(rid, [])]
+
+    total = len(ids)
+    print(f"Запросов: {total}, ошибок: {errors}, время: {wall:.3f} c, пропускная способность: {total / wall if wall else 0:.1f} req/s")
+    print(
+        "Латентность, мс: "
+        f"p50={_percentile(latencies, 50) * 1000:.2f} "
+        f"p95={_percentile(latencies, 95) * 1000:.2f} "
+        f"p99={_percentile(latencies, 99) * 1000:.2f} "
+        f"max={max(latencies, default=0) * 1000:.2f}"
+    )
+    print(f"Расхождений в исходящих: {len(diffs)} из {total}")
+    for rid in diffs[: args.show_diffs]:
+        print(f"--- {rid}")
+        for line in difflib.unified_diff(expected.get(rid, []), actual.get(rid, []), "captured", "replayed", lineterm=""):
+            print(line)
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        print(f"Состояние после прогона: {workdir}")
+    return 1 if (errors or diffs) else 0
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Replay захваченных webhook против локальных заглушек")
+    parser.add_argument("capture", help="папка WEBHOOK_CAPTURE_DIR или отдельный сегмент")
+    parser.add_argument("--speed", type=float, default=0, help="1 — исходный темп, N — в N раз быстрее, 0 — без пауз")
+    parser.add_argument("--state", help="исходный dialog_memory.json")
+    parser.add_argument("--sent", help="исходный sent_events.json")
+    parser.add_argument("--admin-chat", type=int, help="ADMIN_CHAT_ID, с которым писался журнал (по умолчанию из env)")
+    parser.add_argument("--limit", type=int, default=0, help="прогнать только первые N запросов")
+    parser.add_argument("--show-diffs", type=int, default=10, help="сколько расхождений показать")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку с состоянием")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(replay(args)))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,124 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("stats")
+
+# ---------------------------------------------------------------------
+# Счётчики событий для админской команды /stats.
+# Храним не историю, а корзины: по часам (последние двое суток) и по дням
+# (последний год) + итоги за всё время. Файл маленький и не растёт с историей,
+# поэтому и инкремент, и ответ на /stats — за постоянное время.
+# ---------------------------------------------------------------------
+STATS_FILE = "stats.json"
+HOURS_KEEP = 48
+DAYS_KEEP = 400
+# бизнес живёт по Казани — сутки считаем по местному времени
+UTC_OFFSET_HOURS = int(os.getenv("STATS_UTC_OFFSET_HOURS", "3"))
+
+# события, которые показываем в /stats (ключ -> подпись)
+EVENTS = {
+    "phone_linked": "Привязали номер",
+    "booking_webhook": "Новых записей (webhook)",
+    "confirmation_sent": "Отбивок отправлено",
+    "backfill_visits": "Визитов из backfill",
+    "booking_unlinked": "Записей от непривязанных",
+    "booking_no_phone": "Записей без телефона",
+}
+
+
+def local_now() -> datetime:
+    """Текущее время студии (наивное, как и время записей в YCLIENTS)."""
+    return datetime.utcnow() + timedelta(hours=UTC_OFFSET_HOURS)
+
+
+def _load() -> dict:
+    try:
+        if not os.path.exists(STATS_FILE):
+            return {}
+        with open(STATS_FILE, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        return d if isinstance(d, dict) else {}
+    except Exception:
+        return {}
+
+
+def _save(data: dict):
+    tmp = f"{STATS_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, STATS_FILE)
+    except Exception as e:
+        logger.error(f"Не смог сохранить {STATS_FILE}: {e}")
+
+
+def _prune(buckets: dict, keep: int):
+    if len(buckets) > keep:
+        for key in sorted(buckets)[: len(buckets) - keep]:
+            del buckets[key]
+
+
+def incr(event: str, n: int = 1, now: datetime | None = None):
+    """Учесть событие в часовой и дневной корзинах и в итогах."""
+    now = now or local_now()
+    data = _load()
+    hourly = data.setdefault("h", {})
+    daily = data.setdefault("d", {})
+    totals = data.setdefault("t", {})
+
+    h = hourly.setdefault(now.strftime("%Y%m%d%H"), {})
+    h[event] = h.get(event, 0) + n
+    d = daily.setdefault(now.strftime("%Y%m%d"), {})
+    d[event] = d.get(event, 0) + n
+    totals[event] = totals.get(event, 0) + n
+
+    _prune(hourly, HOURS_KEEP)
+    _prune(daily, DAYS_KEEP)
+    _save(data)
+
+
+def adjust_gauge(name: str, delta: int, initial=None):
+    """
+    Изменить «абсолютную» величину (например, число привязанных клиентов).
+    initial() вызывается один раз, если величина ещё не посчитана.
+    """
+    data = _load()
+    gauges = data.setdefault("g", {})
+    if name not in gauges:
+        gauges[name] = int(initial()) if initial else 0
+    gauges[name] += delta
+    _save(data)
+
+
+def get_gauge(name: str, initial=None) -> int:
+    data = _load()
+    gauges = data.setdefault("g", {})
+    if name not in gauges and initial:
+        gauges[name] = int(initial())
+        _save(data)
+    return int(gauges.get(name, 0))
+
+
+def _sum(buckets: dict, keys) -> dict:
+    out: dict[str, int] = {}
+    for key in keys:
+        for event, n in (buckets.get(key) or {}).items():
+            out[event] = out.get(event, 0) + n
+    return out
+
+
+def summary(now: datetime | None = None) -> dict:
+    """Окна: последние 24 часа, сегодня, 7 и 30 дней, всё время."""
+    now = now or local_now()
+    data = _load()
+    hourly = data.get("h", {})
+    daily = data.get("d", {})
+    return {
+        "24h": _sum(hourly, ((now - timedelta(hours=i)).strftime("%Y%m%d%H") for i in range(24))),
+        "today": _sum(daily, [now.strftime("%Y%m%d")]),
+        "7d": _sum(daily, ((now - timedelta(days=i)).strftime("%Y%m%d") for i in range(7))),
+        "30d": _sum(daily, ((now - timedelta(days=i)).strftime("%Y%m%d") for i in range(30))),
+        "all": dict(data.get("t", {})),
+    }
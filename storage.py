@@ -18,8 +18,13 @@ def _read_file() -> dict:
 
 
 def _write_file(data: dict) -> None:
-    with open(FILE_PATH, "w", encoding="utf-8") as f:
+    # атомарно: временный файл + os.replace, чтобы не оставить полузаписанный JSON
+    tmp = f"{FILE_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, FILE_PATH)
 
 
 async def upsert_user(tg_id: int, name: str | None = None):
@@ -1,8 +1,15 @@
 import os
+import re
+import time
+import random
+import asyncio
 import logging
 import aiohttp
+from datetime import datetime, timedelta
 from typing import Any
 
+import capture
+
 logger = logging.getLogger("yclients_api")
 
 # Базовый URL API.
@@ -28,16 +35,198 @@ def get_headers() -> dict:
 
     return headers
 
+# ---------------------------------------------------------------------
+# Устойчивость вызовов YCLIENTS: таймауты по эндпоинтам, общий бюджет
+# ретраев и circuit breaker на каждый шаблон эндпоинта. Если YCLIENTS
+# лежит — не висим на каждом webhook, а сразу падаем с YClientsUnavailable.
+# ---------------------------------------------------------------------
+CONNECT_TIMEOUT = float(os.getenv("YCLIENTS_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("YCLIENTS_READ_TIMEOUT", "10"))
+
+# шаблон эндпоинта -> (connect, read); то, чего нет в таблице, берёт значения по умолчанию
+ENDPOINT_TIMEOUTS: dict[str, tuple[float, float]] = {
+    # запись нужна прямо в обработчике webhook — ждём недолго
+    "/record/{id}/{id}": (CONNECT_TIMEOUT, 5.0),
+    "/records/{id}/{id}": (CONNECT_TIMEOUT, 5.0),
+    "/record/{id}": (CONNECT_TIMEOUT, 5.0),
+    "/records/{id}": (CONNECT_TIMEOUT, 5.0),
+}
+
+BREAKER_FAILURES = int(os.getenv("YCLIENTS_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("YCLIENTS_BREAKER_COOLDOWN", "30"))
+
+RETRY_MAX_ATTEMPTS = 2
+RETRY_BUDGET_RATIO = 0.1      # ретраи — не больше ~10% от обычных запросов
+RETRY_BUDGET_MIN_PER_SEC = 0.5
+RETRY_BUDGET_CAP = 10.0
+
+class YClientsUnavailable(Exception):
+    """YCLIENTS недоступен: circuit breaker открыт или запрос не удался после ретраев."""
+
+class _Breaker:
+    """closed -> (N ошибок подряд) -> open -> (cooldown) -> half_open -> closed/open."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.total_rejected += 1
+        return False
+
+    def on_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def on_failure(self):
+        self.failures += 1
+        self.total_failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.failures >= BREAKER_FAILURES:
+            if self.state != "open":
+                logger.warning(f"YCLIENTS circuit OPEN: {self.endpoint}")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        retry_in = 0.0
+        if self.state == "open":
+            retry_in = max(0.0, BREAKER_COOLDOWN - (time.monotonic() - self.opened_at))
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "total_rejected": self.total_rejected,
+            "retry_in": round(retry_in, 1),
+        }
+
+class _RetryBudget:
+    """Общий для всех эндпоинтов бюджет ретраев (token bucket), чтобы ретраи не умножали нагрузку при аварии."""
+
+    def __init__(self):
+        self.tokens = RETRY_BUDGET_CAP
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(RETRY_BUDGET_CAP, self.tokens + (now - self.updated) * RETRY_BUDGET_MIN_PER_SEC)
+        self.updated = now
+
+    def deposit(self):
+        self._refill()
+        self.tokens = min(RETRY_BUDGET_CAP, self.tokens + RETRY_BUDGET_RATIO)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+_breakers: dict[str, _Breaker] = {}
+_retry_budget = _RetryBudget()
+_session: aiohttp.ClientSession | None = None
+
+def endpoint_template(url: str) -> str:
+    """https://.../record/530777/123 -> /record/{id}/{id}"""
+    path = url[len(BASE_URL):] if url.startswith(BASE_URL) else url
+    path = path.split("?", 1)[0]
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+def _breaker(endpoint: str) -> _Breaker:
+    br = _breakers.get(endpoint)
+    if br is None:
+        br = _breakers[endpoint] = _Breaker(endpoint)
+    return br
+
+def breaker_states() -> dict:
+    """Состояние всех breaker'ов и бюджета ретраев — для мониторинга."""
+    return {
+        "endpoints": {ep: br.snapshot() for ep, br in _breakers.items()},
+        "retry_budget": round(_retry_budget.tokens, 2),
+    }
+
+def is_degraded() -> bool:
+    return any(br.state != "closed" for br in _breakers.values())
+
+def _get_session() -> aiohttp.ClientSession:
+    # одна сессия (пул соединений) на процесс вместо новой на каждый запрос
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def _request_with_meta(method: str, url: str, headers: dict, params: dict | None = None, json_data: Any | None = None) -> tuple[int, dict, Any]:
+    """Как _request, но дополнительно отдаёт HTTP-статус и заголовки ответа (нужно для ETag)."""
+    endpoint = endpoint_template(url)
+    br = _breaker(endpoint)
+    connect_t, read_t = ENDPOINT_TIMEOUTS.get(endpoint, (CONNECT_TIMEOUT, READ_TIMEOUT))
+    timeout = aiohttp.ClientTimeout(total=connect_t + read_t, sock_connect=connect_t, sock_read=read_t)
+    # повторять безопасно только идемпотентные запросы
+    attempts = RETRY_MAX_ATTEMPTS if method.upper() == "GET" else 1
+
+    last_error = ""
+    for attempt in range(attempts):
+        if attempt == 0:
+            _retry_budget.deposit()
+        elif not _retry_budget.withdraw():
+            logger.warning(f"YCLIENTS retry budget exhausted: {endpoint}")
+            break
+        else:
+            await asyncio.sleep(0.2 * attempt + random.random() * 0.2)
+
+        if not br.allow():
+            raise YClientsUnavailable(f"circuit open: {endpoint}")
+
+        try:
+            async with _get_session().request(method, url, headers=headers, params=params, json=json_data, timeout=timeout) as resp:
+                resp_headers = dict(resp.headers)
+                if resp.status == 429 or resp.status >= 500:
+                    br.on_failure()
+                    last_error = f"HTTP {resp.status}"
+                    continue
+                br.on_success()
+                if resp.status == 304:
+                    return resp.status, resp_headers, None
+                try:
+                    data = await resp.json()
+                except Exception:
+                    raw = await resp.text()
+                    logger.error(f"YCLIENTS non-json response: {raw}")
+                    return resp.status, resp_headers, {"success": False, "raw": raw, "status": resp.status}
+                return resp.status, resp_headers, data
+        except asyncio.CancelledError:
+            br.probe_in_flight = False
+            raise
+        except Exception as e:
+            # таймауты, обрывы соединения, DNS и т.п.
+            br.on_failure()
+            last_error = repr(e)
+
+    raise YClientsUnavailable(f"{endpoint}: {last_error or 'no attempts left'}")
+
 async def _request(method: str, url: str, headers: dict, params: dict | None = None, json_data: Any | None = None) -> Any:
-    async with aiohttp.ClientSession() as session:
-        async with session.request(method, url, headers=headers, params=params, json=json_data) as resp:
-            try:
-                data = await resp.json()
-            except Exception:
-                raw = await resp.text()
-                logger.error(f"YCLIENTS non-json response: {raw}")
-                return {"success": False, "raw": raw, "status": resp.status}
-            return data
+    _, _, data = await _request_with_meta(method, url, headers, params=params, json_data=json_data)
+    return data
 
 def _extract_data_list(resp_json: Any) -> list[dict] | None:
     if not isinstance(resp_json, dict):
@@ -58,17 +247,208 @@ def _extract_data_dict(resp_json: Any) -> dict | None:
     return None
 
 # ---------------------------------------------------------------------
-# ВНИМАНИЕ: функции ниже (get_categories и т.п.) оставлены заглушками
+# Справочники мастеров и услуг (локальный кэш).
+# Меняются редко, поэтому держим их в памяти, индексированными по id,
+# и обновляем в фоне (TTL + ETag/If-None-Match). Это позволяет дорисовать
+# название услуги, цену и имя мастера по id из webhook без лишних запросов.
+# ---------------------------------------------------------------------
+REFDATA_TTL = int(os.getenv("YCLIENTS_REFDATA_TTL", "3600"))
+# справочник не загрузился (нет прав у токена, 404, API лежит) — столько секунд
+# webhook не пытается грузить его сам, этим занимается только фоновый цикл
+REFDATA_RETRY_AFTER = int(os.getenv("YCLIENTS_REFDATA_RETRY_AFTER", "300"))
+
+# kind -> варианты путей (как и в get_record_by_id, у разных аккаунтов работают разные)
+_REFDATA_PATHS = {
+    "staff": ("/company/{company_id}/staff", "/staff/{company_id}"),
+    "services": ("/company/{company_id}/services", "/services/{company_id}"),
+}
+
+class _RefCatalog:
+    """Один справочник одной компании: записи по id + ETag + время загрузки."""
+
+    def __init__(self, kind: str, company_id: int):
+        self.kind = kind
+        self.company_id = company_id
+        self.by_id: dict[str, dict] = {}
+        self.etag = ""
+        self.url = ""
+        self.loaded_at = 0.0
+        self.failed_at: float | None = None
+        self.lock = asyncio.Lock()
+        self.refreshing: asyncio.Task | None = None
+
+    def is_loaded(self) -> bool:
+        return self.loaded_at > 0
+
+    def is_stale(self, margin: float = 0.0) -> bool:
+        """Истёк TTL (или истечёт в ближайшие margin секунд)."""
+        return time.monotonic() - self.loaded_at >= REFDATA_TTL - margin
+
+    def may_load_inline(self) -> bool:
+        """Можно ли грузить прямо из webhook: никто уже не грузит и недавно не было неудачи."""
+        if self.lock.locked():
+            return False
+        return self.failed_at is None or time.monotonic() - self.failed_at >= REFDATA_RETRY_AFTER
+
+    async def refresh(self) -> bool:
+        async with self.lock:
+            headers = get_headers()
+            urls = [self.url] if self.url else [
+                BASE_URL + p.format(company_id=self.company_id) for p in _REFDATA_PATHS[self.kind]
+            ]
+            for url in urls:
+                req_headers = dict(headers)
+                if self.etag and url == self.url:
+                    req_headers["If-None-Match"] = self.etag
+                try:
+                    status, resp_headers, data = await _request_with_meta("GET", url, req_headers)
+                except Exception as e:
+                    logger.error(f"refdata {self.kind} error {url}: {e}")
+                    continue
+                if status == 304:
+                    self.loaded_at = time.monotonic()
+                    self.failed_at = None
+                    return True
+                items = _extract_data_list(data)
+                if items is None:
+                    continue
+                self.by_id = {str(it["id"]): it for it in items if isinstance(it, dict) and it.get("id") is not None}
+                self.etag = resp_headers.get("ETag") or resp_headers.get("Etag") or ""
+                self.url = url
+                self.loaded_at = time.monotonic()
+                self.failed_at = None
+                # снимок в журнал — replay подставит те же услуги/мастеров/цены
+                capture.capture_upstream("refdata", f"{self.kind}:{self.company_id}", list(self.by_id.values()))
+                logger.info(f"refdata {self.kind} company={self.company_id}: {len(self.by_id)} записей")
+                return True
+            self.failed_at = time.monotonic()
+            logger.warning(f"refdata {self.kind} company={self.company_id}: не загрузился, из webhook не грузим {REFDATA_RETRY_AFTER} с")
+            return False
+
+_catalogs: dict[tuple[str, int], _RefCatalog] = {}
+
+def _catalog(kind: str, company_id: int) -> _RefCatalog:
+    key = (kind, int(company_id))
+    cat = _catalogs.get(key)
+    if cat is None:
+        cat = _catalogs[key] = _RefCatalog(kind, int(company_id))
+    return cat
+
+def load_reference_snapshot(kind: str, company_id: int, items: list):
+    """Подложить справочник целиком (replay: снимок из журнала вместо запроса в API)."""
+    cat = _catalog(kind, company_id)
+    cat.by_id = {str(it["id"]): it for it in items if isinstance(it, dict) and it.get("id") is not None}
+    cat.loaded_at = time.monotonic()
+
+async def refresh_reference_data(company_id: int, force: bool = False, margin: float = 0.0):
+    """Обновить справочники компании (если устарели, устареют в ближайшие margin секунд, или force=True)."""
+    for kind in _REFDATA_PATHS:
+        cat = _catalog(kind, company_id)
+        if force or not cat.is_loaded() or cat.is_stale(margin):
+            await cat.refresh()
+
+async def ensure_reference_data(company_id: int):
+    """
+    Первый раз — грузим синхронно (иначе нечем резолвить),
+    дальше устаревший кэш отдаём как есть и обновляем в фоне.
+    Если справочник недавно не загрузился (или его уже грузят), webhook не ждёт —
+    резолвим без него, загрузку оставляем reference_refresh_loop.
+    """
+    for kind in _REFDATA_PATHS:
+        cat = _catalog(kind, company_id)
+        if not cat.is_loaded():
+            if cat.may_load_inline():
+                await cat.refresh()
+        elif cat.is_stale() and (cat.refreshing is None or cat.refreshing.done()):
+            cat.refreshing = asyncio.create_task(cat.refresh())
+
+async def reference_refresh_loop(company_id: int):
+    """Фоновая задача: периодически обновляет справочники (запускается на старте приложения)."""
+    interval = max(60, REFDATA_TTL // 2)
+    while True:
+        # обновляем то, что истечёт до следующего прохода, — чтобы webhook не застал кэш устаревшим
+        try:
+            await refresh_reference_data(company_id, margin=interval)
+        except Exception as e:
+            logger.error(f"refdata refresh loop error: {e}")
+        await asyncio.sleep(interval)
+
+def get_staff_cached(company_id: int, staff_id: Any) -> dict | None:
+    if staff_id in (None, ""):
+        return None
+    return _catalog("staff", company_id).by_id.get(str(staff_id))
+
+def get_service_cached(company_id: int, service_id: Any) -> dict | None:
+    if service_id in (None, ""):
+        return None
+    return _catalog("services", company_id).by_id.get(str(service_id))
+
+def _service_price(svc: dict) -> str:
+    lo, hi = svc.get("price_min"), svc.get("price_max")
+    if lo in (None, "") and hi in (None, ""):
+        return ""
+    if lo in (None, "") or lo == hi or hi in (None, ""):
+        return str(lo if lo not in (None, "") else hi)
+    return f"{lo}–{hi}"
+
+def resolve_record_refs(company_id: int, rec: dict) -> dict:
+    """
+    По id услуги/мастера из webhook (или записи) достаём из кэша название услуги,
+    цену и имя мастера. Никаких запросов к API — только то, что уже в памяти.
+    """
+    service = ""
+    price = ""
+    master = ""
+
+    services = rec.get("services") if isinstance(rec.get("services"), list) else []
+    s0 = services[0] if services and isinstance(services[0], dict) else {}
+    svc_id = s0.get("id") or rec.get("service_id")
+    if s0.get("cost") is not None:
+        price = str(s0.get("cost"))
+    elif s0.get("price") is not None:
+        price = str(s0.get("price"))
+    service = s0.get("title") or s0.get("name") or ""
+    svc = get_service_cached(company_id, svc_id)
+    if svc:
+        service = service or svc.get("title") or svc.get("name") or ""
+        price = price or _service_price(svc)
+
+    staff_id = rec.get("staff_id")
+    if isinstance(rec.get("staff"), dict):
+        staff_id = staff_id or rec["staff"].get("id")
+        master = rec["staff"].get("name") or ""
+    staff = get_staff_cached(company_id, staff_id)
+    if staff and not master:
+        master = staff.get("name") or ""
+
+    return {"service": service, "master": master, "price": price}
+
+# ---------------------------------------------------------------------
+# ВНИМАНИЕ: get_categories и create_booking оставлены заглушками
 # для совместимости со старым main.py. В вашей текущей задаче они не нужны.
 # ---------------------------------------------------------------------
 async def get_categories(*args, **kwargs):
     return []
 
-async def get_services_by_category(*args, **kwargs):
-    return []
+async def get_services_by_category(company_id: int, category_id: Any) -> list[dict]:
+    """Услуги категории — из кэша справочников."""
+    await ensure_reference_data(company_id)
+    cid = str(category_id)
+    return [s for s in _catalog("services", company_id).by_id.values() if str(s.get("category_id")) == cid]
 
-async def get_masters_for_service(*args, **kwargs):
-    return []
+async def get_masters_for_service(company_id: int, service_id: Any) -> list[dict]:
+    """Мастера, оказывающие услугу (service["staff"] = [{"id": ...}, ...]) — из кэша справочников."""
+    await ensure_reference_data(company_id)
+    svc = get_service_cached(company_id, service_id)
+    if not svc:
+        return []
+    out = []
+    for link in svc.get("staff") or []:
+        sid = link.get("id") if isinstance(link, dict) else link
+        staff = get_staff_cached(company_id, sid)
+        if staff:
+            out.append(staff)
+    return out
 
 async def create_booking(*args, **kwargs):
     return {"success": False, "error": "booking disabled"}
@@ -77,6 +457,7 @@ async def create_booking(*args, **kwargs):
 # Получить запись по id (для webhook, чтобы вытащить телефон/услугу)
 # ---------------------------------------------------------------------
 async def get_record_by_id(company_id: int, record_id: str) -> dict | None:
+    """None — записи нет ни по одному варианту URL; YClientsUnavailable — YCLIENTS не ответил."""
     headers = get_headers()
     rid = str(record_id).strip()
     if not rid:
@@ -89,13 +470,92 @@ async def get_record_by_id(company_id: int, record_id: str) -> dict | None:
         f"{BASE_URL}/records/{rid}",
     ]
 
+    # варианты URL — про разную форму API у аккаунтов, а не про доступность:
+    # если YCLIENTS не отвечает, остальные варианты только добавят таймаутов
     for url in candidates:
         try:
             data = await _request("GET", url, headers)
-            rec = _extract_data_dict(data)
-            if rec is not None:
-                return rec
+        except YClientsUnavailable:
+            raise
         except Exception as e:
             logger.error(f"get_record_by_id error {url}: {e}")
+            continue
+        rec = _extract_data_dict(data)
+        if rec is not None:
+            return rec
 
     return None
+
+# ---------------------------------------------------------------------
+# Поиск клиента по телефону и его будущих записей
+# (для рассылки «ваши ближайшие визиты» сразу после привязки номера)
+# ---------------------------------------------------------------------
+LOOKUP_CONCURRENCY = int(os.getenv("YCLIENTS_LOOKUP_CONCURRENCY", "3"))
+LOOKUP_MIN_INTERVAL = float(os.getenv("YCLIENTS_LOOKUP_MIN_INTERVAL", "0.2"))
+CLIENT_ID_TTL = int(os.getenv("YCLIENTS_CLIENT_ID_TTL", "86400"))
+CLIENT_ID_MISS_TTL = 600  # «не нашли» помним недолго — клиента могут завести в YCLIENTS позже
+UPCOMING_DAYS = int(os.getenv("YCLIENTS_UPCOMING_DAYS", "90"))
+
+class _RateLimiter:
+    """Не больше N запросов одновременно и не чаще одного раза в min_interval секунд."""
+
+    def __init__(self, concurrency: int, min_interval: float):
+        self.sem = asyncio.Semaphore(concurrency)
+        self.min_interval = min_interval
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.min_interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc):
+        self.sem.release()
+
+_lookup_limiter = _RateLimiter(LOOKUP_CONCURRENCY, LOOKUP_MIN_INTERVAL)
+
+# (company_id, phone) -> (client_ids, до какого момента верим)
+_client_ids_cache: dict[tuple[int, str], tuple[list[int], float]] = {}
+
+async def find_client_ids_by_phone(company_id: int, phone: str) -> list[int]:
+    """id клиентов YCLIENTS с этим телефоном (у одного номера бывает несколько карточек)."""
+    digits = re.sub(r"\D+", "", phone or "")
+    if len(digits) < 10:
+        return []
+    key = (int(company_id), digits)
+    cached = _client_ids_cache.get(key)
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
+
+    async with _lookup_limiter:
+        data = await _request("GET", f"{BASE_URL}/clients/{company_id}", get_headers(), params={"phone": digits})
+    items = _extract_data_list(data) or []
+    ids = []
+    for it in items:
+        if not isinstance(it, dict) or it.get("id") is None:
+            continue
+        # поиск по телефону в YCLIENTS нечёткий (а фильтр могут и проигнорировать) —
+        # берём только карточки, где хвост номера совпал; без телефона — не наш клиент
+        if re.sub(r"\D+", "", str(it.get("phone") or ""))[-10:] != digits[-10:]:
+            continue
+        ids.append(int(it["id"]))
+    _client_ids_cache[key] = (ids, time.monotonic() + (CLIENT_ID_TTL if ids else CLIENT_ID_MISS_TTL))
+    return ids
+
+async def get_upcoming_records(company_id: int, client_id: int, now: datetime, days: int = UPCOMING_DAYS) -> list[dict]:
+    """
+    Записи клиента на ближайшие days дней (без удалённых).
+    now — время студии: даты записей в YCLIENTS местные, часовой пояс сервера тут ни при чём.
+    """
+    today = now.strftime("%Y-%m-%d")
+    end = (now + timedelta(days=days)).strftime("%Y-%m-%d")
+    params = {"client_id": client_id, "start_date": today, "end_date": end, "count": 50}
+    async with _lookup_limiter:
+        data = await _request("GET", f"{BASE_URL}/records/{company_id}", get_headers(), params=params)
+    items = _extract_data_list(data) or []
+    return [r for r in items if isinstance(r, dict) and not r.get("deleted")]